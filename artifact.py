@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Mar 16 10:15:00 2022
+@author: WOJJ
+
+Provide the lightweight model artifact of the trained GAMs
+"""
+
+"""
+The artifact is a single compressed npz file holding, for each station:
+    - coef: the coefficients of the GAM
+    - the term specs: features (column positions), n_splines, spline_order, edge knots
+      and basis of the marginal splines of each tensor term
+    - the columns of the features (column -> position of the features)
+    - the registry entry (weather id, nearby stations) and the outlier bounds
+and the pre-processing parameters (ALPHAS, smoothing windows, LAG_STEPS).
+
+The predictions only need NumPy: the B-spline basis of each marginal term is evaluated
+as in pygam (`pygam.utils.b_spline_basis`, linear extrapolation outside the edge knots),
+and each tensor term is contracted with its coefficients without building the model
+matrix, so neither pygam nor scikit-learn is imported.
+
+    save_artifact(trained_gam, "model.npz", outlier_bounds=bounds)
+    artifact = load_artifact("model.npz")
+    prediction = predict_artifact(artifact["stations"][station], test_df)
+"""
+
+import json
+import numpy as np
+
+from preprocess import ALPHAS, LAG_STEPS
+
+ARTIFACT_VERSION = 1
+
+# pre-processing of run.py, the values given to save_artifact override them
+PREPROCESSING = {"alphas": ALPHAS, "load_ws": 7, "national_ws": 5, "skipna": False,
+                 "input_smoothed": True, "lag_steps": LAG_STEPS}
+
+def save_artifact(trained_gam, path, registry=None, outlier_bounds=None, preprocessing=None):
+    # imported here so that loading an artifact does not need the registry file
+    from data_loader import REGISTRY, required_stations
+    registry = REGISTRY if registry is None else registry
+    outlier_bounds = {} if outlier_bounds is None else outlier_bounds
+    meta = {"version": ARTIFACT_VERSION, "preprocessing": dict(PREPROCESSING, **(preprocessing or {})),
+            "registry": {}, "outlier_bounds": {}, "stations": {}}
+    arrays = {}
+    for station in required_stations(list(trained_gam), registry):
+        meta["registry"][station] = registry[station]
+        if station in outlier_bounds:
+            meta["outlier_bounds"][station] = [float(b) for b in outlier_bounds[station]]
+    for i, (station, result) in enumerate(trained_gam.items()):
+        gam = result["gam"]
+        meta["stations"][station] = {"coef": "coef_%s" % i, "columns": list(result["columns"]),
+                                     "terms": gam.term_specs() if hasattr(gam, "term_specs") else [_term_spec(term) for term in gam.terms],
+                                     "train_mape": float(result["train_mape"]), "last_index": str(result["last_index"])}
+        arrays["coef_%s" % i] = gam.coef_
+    np.savez_compressed(path, meta=np.array(json.dumps(meta)), **arrays)
+    print("Model artifact saved to:", path)
+
+def load_artifact(path):
+    with np.load(path) as data:
+        meta = json.loads(str(data["meta"]))
+        if meta["version"] != ARTIFACT_VERSION:
+            raise ValueError("Unsupported artifact version %s in %s" % (meta["version"], path))
+        for spec in meta["stations"].values():
+            spec["coef"] = data[spec["coef"]]
+    return meta
+
+# prediction of one station of the artifact on the features df (pandas.DataFrame or 2-D array)
+def predict_artifact(spec, df):
+    if hasattr(df, "columns"):
+        if list(df.columns) != spec["columns"]:
+            df = df[spec["columns"]]
+        df = df.to_numpy(dtype=np.float64)
+    X = np.asarray(df, dtype=np.float64)
+    prediction = np.zeros(len(X))
+    start = 0
+    for term in spec["terms"]:
+        n_coefs = term_n_coefs(term)
+        coef = spec["coef"][start:start+n_coefs]
+        start += n_coefs
+        if term["type"] == "intercept":
+            prediction += coef[0]
+            continue
+        # contract the marginal bases with the coefficients one marginal at a time:
+        # the coefficients of a tensor term are in the order of the row-wise kronecker product
+        bases = [b_spline_basis(X[:, m["feature"]], m["edge_knots"], m["n_splines"], m["spline_order"],
+                                periodic=m["basis"] == "cp") for m in term["marginals"]]
+        partial = bases[0] @ coef.reshape(bases[0].shape[1], -1)
+        for basis in bases[1:]:
+            partial = np.einsum("na,nab->nb", basis, partial.reshape(len(X), basis.shape[1], -1))
+        prediction += partial[:, 0]
+    return prediction
+
+def term_n_coefs(term):
+    if term["type"] == "intercept":
+        return 1
+    return int(np.prod([m["n_splines"] for m in term["marginals"]]))
+
+# specs of a pygam term (tensor of splines, spline or intercept)
+def _term_spec(term):
+    if term.isintercept:
+        return {"type": "intercept"}
+    marginals = term._terms if term.istensor else [term]
+    for m in marginals:
+        if type(m).__name__ != "SplineTerm" or m.by is not None:
+            raise ValueError("Unsupported term in the artifact: %s" % m)
+    return {"type": "tensor", "marginals": [{"feature": int(m.feature), "n_splines": int(m.n_splines),
+                                             "spline_order": int(m.spline_order), "basis": m.basis,
+                                             "edge_knots": [float(k) for k in m.edge_knots_]} for m in marginals]}
+
+# dense B-spline basis, same as pygam.utils.b_spline_basis (vectorized De Boor recursion)
+def b_spline_basis(x, edge_knots, n_splines=20, spline_order=3, periodic=False):
+    n_splines += spline_order * periodic
+    # rescale edge_knots to [0,1], and generate boundary knots
+    edge_knots = np.sort(edge_knots)
+    offset, scale = edge_knots[0], edge_knots[-1] - edge_knots[0]
+    if scale == 0:
+        scale = 1
+    boundary_knots = np.linspace(0, 1, 1 + n_splines - spline_order)
+    diff = boundary_knots[1] - boundary_knots[0]
+    x = (np.ravel(x) - offset) / scale
+    if periodic:
+        x = x % (1 + 1e-9)
+    # append 0 and 1 in order to get derivatives for extrapolation
+    x = np.r_[x, 0., 1.]
+    extrapolate_l, extrapolate_r = x < 0, x > 1
+    interpolate = ~(extrapolate_l | extrapolate_r)
+    x = x[:, None]
+    # augment knots, the last knot is inclusive
+    aug = np.arange(1, spline_order + 1) * diff
+    aug_knots = np.r_[-aug[::-1], boundary_knots, 1 + aug]
+    aug_knots[-1] += 1e-9
+    # Haar basis, symmetric at 0 and 1
+    bases = ((x >= aug_knots[:-1]) & (x < aug_knots[1:])).astype(float)
+    bases[-1] = bases[-2][::-1]
+    maxi = len(aug_knots) - 1
+    for m in range(2, spline_order + 2):
+        maxi -= 1
+        left = (x - aug_knots[:maxi]) * bases[:, :maxi] / (aug_knots[m-1:maxi+m-1] - aug_knots[:maxi])
+        right = (aug_knots[m:maxi+m] - x) * bases[:, 1:maxi+1] / (aug_knots[m:maxi+m] - aug_knots[1:maxi+1])
+        prev_bases = bases[-2:]
+        bases = left + right
+    if periodic and spline_order > 0:
+        bases[:, :spline_order] = np.maximum(bases[:, :spline_order], bases[:, -spline_order:])
+        bases = bases[:, :-spline_order]
+    # linear extrapolation with the gradients at the end knots
+    if (extrapolate_l.any() or extrapolate_r.any()) and spline_order > 0:
+        bases[~interpolate] = 0.
+        left = prev_bases[:, :-1] / (aug_knots[spline_order:-1] - aug_knots[:-spline_order-1])
+        right = prev_bases[:, 1:] / (aug_knots[spline_order+1:] - aug_knots[1:-spline_order])
+        grads = spline_order * (left - right)
+        if extrapolate_l.any():
+            bases[extrapolate_l] = grads[0] * x[extrapolate_l] + bases[-2]
+        if extrapolate_r.any():
+            bases[extrapolate_r] = grads[1] * (x[extrapolate_r] - 1) + bases[-1]
+    return bases[:-2]
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Mar 19 09:20:00 2022
+@author: WOJJ
+
+Provide the rolling-origin backtest of the GAM and the post-processing methods
+"""
+
+"""
+The forecast origin is slid backwards over the history of the Training Data: each fold
+trains the GAM on the load before its origin and forecasts the following HORIZON_DAYS
+(the 56 days of the test window), as `pack_dataset` does for the test window
+(the load of LAG_STEPS ago is known at every step of the forecast window).
+
+The pre-processing (weather and national demand smoothing, outlier removal, load
+smoothing) is run once on the whole history and shared by all the folds, together with a
+FeatureStore of the calendar, national demand and weather features of the history: with
+n_jobs > 1, they are sent once to each worker process (pool initializer, the store in shared
+memory), and each task (station, origin) only packs its fold. Note that the outlier bounds
+and the initial level of the weather smoothing use the whole history.
+
+A fold needs MIN_TRAIN_DAYS of training targets, plus the 56 days of lag before them and
+the HORIZON_DAYS of its window, i.e. 224 days of history by default.
+
+Post-processing noise floor: there is no EV load in the history, so each post-processing
+method (see `postprocess.evaluate_candidates`) applied to the raw load and the forecast
+estimates the daily max of the forecast error instead of an EV peak. This max is positive
+by construction, and lower for a stronger smoothing of the load, so it is a comparison of
+the noise floor of the methods, not of their accuracy (which needs a known EV load, e.g.
+`show_errors` on phase 1). The signed mean (bias) and the standard deviation (std) of the
+daily estimates over the days of the fold are reported.
+
+The output of the backtest is a pandas.DataFrame object:
+
+                        gam             daily_max       ...     weighted_smoothed_max-17
+                        fit_s   mape    bias    std     ...     bias    std
+station_1   2021-08-09  ...     MAPE    ...
+station_1   2021-06-14  ...
+station_1   mean        ...
+overall     mean        ...
+"""
+
+import time
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.metrics import mean_absolute_percentage_error
+
+from data_loader import REGISTRY
+from preprocess import weather_smoothing, weighted_smoothing, load_outlier_removal, load_smoothing, pack_dataset, align, LAG_STEPS, FeatureStore
+from postprocess import evaluate_candidates, _candidate_keys, SMOOTHING_CANDIDATES
+from gam import initialise_gam
+
+# forecast window of each fold, same as the test window
+HORIZON_DAYS = 56
+STEP = pd.Timedelta(minutes=15)
+LAG_DAYS = LAG_STEPS * STEP // pd.Timedelta(days=1)
+
+# days of training targets of the first fold
+MIN_TRAIN_DAYS = 2 * HORIZON_DAYS
+
+# pre-processed inputs shared by the folds (set once per process)
+_INPUTS = None
+
+# origins of the folds, every step_days backwards from the last forecast window inside the history
+def fold_origins(index, n_folds=4, step_days=HORIZON_DAYS, min_train_days=MIN_TRAIN_DAYS):
+    last = (index[-1] + STEP - pd.Timedelta(days=HORIZON_DAYS)).floor('D')
+    origins = [last - pd.Timedelta(days=step_days*i) for i in range(n_folds)]
+    # LAG_STEPS rows of history are needed before the first training target
+    return [origin for origin in origins if origin - pd.Timedelta(days=min_train_days) - LAG_STEPS*STEP >= index[0]]
+
+# the pre-processing of run.py on a copy of the loaded data, the raw load is kept for the post-processing
+def preprocess_inputs(data_by_station, national_demand, registry=None, input_smoothed=True, skipna=False):
+    registry = REGISTRY if registry is None else registry
+    data_by_station = {station: {"Training Data": data["Training Data"].copy(), "Weather Data": data["Weather Data"]}
+                       for station, data in data_by_station.items()}
+    raw_load = {station: data["Training Data"].value.copy() for station, data in data_by_station.items()}
+    weather_smoothing(data_by_station)
+    national_demand = weighted_smoothing(national_demand).value
+    load_outlier_removal(data_by_station, registry=registry)
+    if input_smoothed:
+        load_smoothing(data_by_station, skipna=skipna)
+    # the forecast windows of the folds are inside the history
+    store = FeatureStore.from_stations(data_by_station, national_demand, list(data_by_station), registry, test_index=pd.DatetimeIndex([]))
+    return {"data_by_station": data_by_station, "national_demand": national_demand, "raw_load": raw_load,
+            "registry": registry, "input_smoothed": input_smoothed, "store": store}
+
+def backtest(data_by_station, national_demand, stations, registry=None, n_folds=4, step_days=HORIZON_DAYS,
+             gam_params={"lam": 0.1}, te_params={"n_splines": 10}, backend="pygam", input_smoothed=True, skipna=False,
+             smoothing_candidate=SMOOTHING_CANDIDATES, n_jobs=1):
+    global _INPUTS
+    inputs = preprocess_inputs(data_by_station, national_demand, registry=registry, input_smoothed=input_smoothed, skipna=skipna)
+    tasks = [(station, origin) for station in stations
+             for origin in fold_origins(inputs["raw_load"][station].index, n_folds=n_folds, step_days=step_days)]
+    if len(tasks) == 0:
+        raise ValueError("No station has enough history for a fold: %s days are needed (%s days of training, "
+                         "the 56-day lag and the %s-day window)" % (MIN_TRAIN_DAYS + LAG_DAYS + HORIZON_DAYS, MIN_TRAIN_DAYS, HORIZON_DAYS))
+    params = {"gam_params": gam_params, "te_params": te_params, "backend": backend, "smoothing_candidate": smoothing_candidate}
+    if n_jobs == 1 or len(tasks) < 2:
+        _INPUTS = inputs
+        results = [backtest_fold(station, origin, **params) for station, origin in tasks]
+    else:
+        inputs["store"].share()
+        try:
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(inputs,)) as executor:
+                futures = [executor.submit(backtest_fold, station, origin, **params) for station, origin in tasks]
+                results = [future.result() for future in futures]
+        finally:
+            inputs["store"].close()
+
+    keys = [("gam", "fit_s"), ("gam", "mape")] + [(key, stat) for key in _candidate_keys(smoothing_candidate) for stat in ["bias", "std"]]
+    rows = []
+    for station in stations:
+        folds = [(origin, result) for (s, origin), result in zip(tasks, results) if s == station]
+        if len(folds) == 0:
+            print(station, " has not enough history for a fold")
+            continue
+        rows += [((station, origin.strftime("%Y-%m-%d")), result) for origin, result in folds]
+        rows.append(((station, "mean"), pd.DataFrame([result for _, result in folds]).mean(axis=0)))
+    report = pd.DataFrame([[result[key] for key in keys] for _, result in rows], index=pd.MultiIndex.from_tuples([key for key, _ in rows]),
+                          columns=pd.MultiIndex.from_tuples(keys), dtype=float)
+    report.loc[("overall", "mean"), :] = report.xs("mean", level=1).mean(axis=0)
+    print("="*20, "\nBacktest: held-out MAPE of the GAM and noise floor (bias, std) of the daily peak by post-process method\n")
+    print(report, "\n", "="*20)
+    return report
+
+def _init_worker(inputs):
+    global _INPUTS
+    _INPUTS = inputs
+
+# fit time, forecast MAPE and post-processing errors of the fold of one station at one origin
+def backtest_fold(station, origin, gam_params={"lam": 0.1}, te_params={"n_splines": 10}, backend="pygam",
+                  smoothing_candidate=SMOOTHING_CANDIDATES, num_fixed_col=12):
+    registry, data_by_station = _INPUTS["registry"], _INPUTS["data_by_station"]
+    test_index = pd.date_range(origin, origin + pd.Timedelta(days=HORIZON_DAYS), freq='15T', closed='left')
+    # the load before the origin of the station and its nearby stations
+    nearby = registry[station]["nearby"]
+    fold_data = {s: {"Training Data": data_by_station[s]["Training Data"][data_by_station[s]["Training Data"].index < origin],
+                     "Weather Data": data_by_station[s]["Weather Data"]} for s in [station] + list(nearby)}
+    dataset = pack_dataset(fold_data, _INPUTS["national_demand"], [station], input_smoothed=_INPUTS["input_smoothed"],
+                           registry=registry, test_index=test_index, store=_INPUTS["store"])[station]
+    train_df, test_df = dataset["train"], dataset["test"]
+    train_df, train_label = train_df[test_df.columns], train_df["target"]
+
+    gam = initialise_gam(train_df, gam_params=gam_params, te_params=te_params, num_fixed_col=num_fixed_col-1, backend=backend) # -1 due to the target column
+    fit_s = time.perf_counter()
+    gam.fit(train_df, train_label)
+    fit_s = time.perf_counter() - fit_s
+    prediction = pd.Series(gam.predict(test_df), index=test_df.index)
+
+    # forecast error on the pre-processed load (the target of the GAM)
+    target = align(data_by_station[station]["Training Data"], test_df.index)
+    known = ~np.isnan(target)
+    result = {("gam", "fit_s"): fit_s, ("gam", "mape"): mean_absolute_percentage_error(target[known], prediction[known])}
+    # daily peak estimated from the raw load of the fold (no EV load): noise floor of each method
+    raw_load = _INPUTS["raw_load"][station]
+    raw_load = raw_load[(raw_load.index >= test_index[0]) & (raw_load.index <= test_index[-1])]
+    for key, estimate in evaluate_candidates(raw_load, prediction, smoothing_candidate).items():
+        result[(key, "bias")] = np.nanmean(estimate.to_numpy())
+        result[(key, "std")] = np.nanstd(estimate.to_numpy())
+    print(station, origin.strftime("%Y-%m-%d"), ' Fold MAPE: ', result[("gam", "mape")])
+    return result
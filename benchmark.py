@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Mar 12 10:20:00 2022
+@author: WOJJ
+
+Benchmark of the stages of `run.py` on synthetic data
+
+    python ./benchmark.py --stations 3 --days 365 --n-splines 4
+    python ./benchmark.py --stations 30 --synthetic-registry
+
+Synthetic station, weather and national demand data are generated in the folder
+layout expected by `data_loader.py` (see `make_synthetic_data`), then each stage
+of the workflow is timed (wall and CPU time) and, with --memory, its peak memory
+is traced with tracemalloc (numpy allocations included).
+With --synthetic-registry, a registry of any number of synthetic stations (3 per phase)
+is generated instead of using the stations of `stations.json`.
+
+    Stage 1: load       - load_data
+    Stage 2: preprocess - weather_smoothing, load_outlier_removal, load_smoothing
+    Stage 3: pack       - pack_dataset
+    Stage 4: train      - train_gam
+    Stage 5: postprocess - generate_prediction, show_errors
+"""
+
+import os
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+from data_loader import load_data, phase_stations, REGISTRY, STATIONS
+from preprocess import weather_smoothing, weighted_smoothing, load_outlier_removal, load_smoothing, pack_dataset
+from gam import train_gam
+from postprocess import generate_prediction, show_errors
+
+import warnings
+warnings.filterwarnings("ignore")
+
+# the test window used by pack_dataset starts on 2021-10-04
+TEST_START = pd.Timestamp("2021-10-04")
+TEST_DAYS = 56
+# national demand files available to load_national_demand
+ND_YEARS = [2019, 2020, 2021]
+
+# registry of n synthetic stations, 3 per phase, each using the load of the previous station of its phase
+def synthetic_registry(n_stations, n_weathers=5):
+    registry = {}
+    for i in range(n_stations):
+        nearby = ["SYNTHETIC CB %s" % (i-1)] if i % 3 > 0 else []
+        registry["SYNTHETIC CB %s" % i] = {"phase": i // 3 + 1, "weather": i % n_weathers,
+                                           "nearby": nearby, "outlier_removal": i % 2 == 0}
+    return registry
+
+# load_data expects the data of all the stations of the registry, the number of stations only changes the training
+def make_synthetic_data(data_folder, days=365, seed=0, registry=None):
+    registry = REGISTRY if registry is None else registry
+    max_days = (TEST_START - pd.Timestamp("%s-01-01" % ND_YEARS[0])).days
+    if days > max_days:
+        print("History is limited to %s days by the national demand data" % max_days)
+        days = max_days
+    rng = np.random.default_rng(seed)
+    phases = sorted(set(entry["phase"] for entry in registry.values()))
+    for folder in ["phase-%s" % phase for phase in phases] + ["weather_data", "national_demand"]:
+        os.makedirs(os.path.join(data_folder, folder), exist_ok=True)
+    history = pd.date_range(TEST_START - pd.Timedelta(days=days), TEST_START, freq='15T', closed='left')
+    test = pd.date_range(TEST_START, TEST_START + pd.Timedelta(days=TEST_DAYS), freq='15T', closed='left')
+    # daily and weekly profiles of the load, plus outliers
+    for i, (station, entry) in enumerate(registry.items()):
+        phase = entry["phase"]
+        t = np.arange(len(history) + len(test))
+        load = 2 + np.sin(2*np.pi*t/96 + i) + 0.3*np.sin(2*np.pi*t/(96*7)) + 0.1*rng.standard_normal(len(t))
+        training = load[:len(history)].copy()
+        training[rng.integers(0, len(history), 5)] = 30
+        pd.DataFrame({"time": history, "value": training, "units": 9}).to_csv(
+            os.path.join(data_folder, "phase-%s" % phase, "%s Training Data.csv" % station))
+        # EV charging on top of the load in the test window
+        ev = 0.5 * np.clip(np.sin(2*np.pi*t[len(history):]/96), 0, None)
+        pd.DataFrame({"time": test, "value": load[len(history):] + ev}).to_csv(
+            os.path.join(data_folder, "phase-%s" % phase, "%s Combined Load %s.csv" % (station, TEST_START.year)), index=False)
+    # template and solution of each phase (stations x 56 days)
+    dates = pd.date_range(TEST_START, periods=TEST_DAYS, freq='D')
+    for phase in phases:
+        n = len(phase_stations(phase, registry))
+        template = pd.DataFrame({"date": np.tile(dates.strftime("%Y-%m-%d"), n), "value": 0.})
+        template.to_csv(os.path.join(data_folder, "phase-%s" % phase, "template_%s.csv" % phase), index=False)
+        solution = pd.DataFrame({"date": np.tile(dates.strftime("%d/%m/%Y"), n), "value": 0.5 + 0.05*rng.standard_normal(n*TEST_DAYS)})
+        solution.to_csv(os.path.join(data_folder, "phase-%s" % phase, "solution_phase%s.csv" % phase), index=False)
+    # hourly weather covering the history and the test window
+    weather_index = pd.date_range(history[0] - pd.Timedelta(days=1), test[-1] + pd.Timedelta(days=1), freq='H')
+    t = np.arange(len(weather_index))
+    for weather_id in sorted(set(entry["weather"] for entry in registry.values())):
+        pd.DataFrame({"datetime": weather_index,
+                      "temperature": 10 + 5*np.sin(2*np.pi*t/24) + rng.standard_normal(len(t)),
+                      "solar_irradiance": 300*np.clip(np.sin(2*np.pi*t/24), 0, None),
+                      "windspeed_north": rng.standard_normal(len(t)),
+                      "windspeed_east": rng.standard_normal(len(t))}).to_csv(
+            os.path.join(data_folder, "weather_data", "df_weather_%s_hourly.csv" % weather_id), index=False)
+    # half-hourly national demand
+    for year in ND_YEARS:
+        t = np.arange(len(pd.date_range('%s-01-01' % year, '%s-01-01' % (year+1), freq='30T', closed='left')))
+        pd.DataFrame({"ENGLAND_WALES_DEMAND": 25000 + 5000*np.sin(2*np.pi*t/48) + 100*rng.standard_normal(len(t))}).to_csv(
+            os.path.join(data_folder, "national_demand", "demanddata_%s.csv" % year), index=False)
+
+class StageTimer:
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.results = []
+
+    def run(self, name, func, *args, **kwargs):
+        if self.memory:
+            tracemalloc.start()
+        wall, cpu = time.perf_counter(), time.process_time()
+        output = func(*args, **kwargs)
+        result = {"stage": name, "wall_s": time.perf_counter() - wall, "cpu_s": time.process_time() - cpu}
+        if self.memory:
+            result["peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+        self.results.append(result)
+        return output
+
+def run_benchmark(data_folder, n_stations=3, n_splines=4, lam=0.1, memory=False, n_jobs=1, registry=None, load_days=None):
+    registry = REGISTRY if registry is None else registry
+    timer = StageTimer(memory=memory)
+    stations = list(registry)[:n_stations]
+    # only the last load_days of history are loaded
+    start = None if load_days is None else TEST_START - pd.Timedelta(days=load_days)
+
+    data_by_station, combined_load_by_station, national_demand = timer.run("load", load_data, data_folder, cache=False, registry=registry, start=start)
+
+    def preprocess():
+        weather_smoothing(data_by_station)
+        load_outlier_removal(data_by_station, registry=registry)
+        load_smoothing(data_by_station)
+        return weighted_smoothing(national_demand).value
+    national_demand = timer.run("preprocess", preprocess)
+
+    dataset_by_station = timer.run("pack", pack_dataset, data_by_station, national_demand, stations, input_smoothed=True, registry=registry)
+
+    trained_gam = timer.run("train", train_gam, dataset_by_station, gam_params={"lam": lam}, te_params={"n_splines": n_splines}, n_jobs=n_jobs)
+
+    def postprocess():
+        generate_prediction(trained_gam, combined_load_by_station, method="averaged_smoothed_max", ws=13)
+        # the error matrix needs all the stations of phase 1
+        phase_1 = phase_stations(1, registry)
+        if all(s in trained_gam for s in phase_1):
+            show_errors({s: trained_gam[s] for s in phase_1}, combined_load_by_station, 1, data_folder, registry=registry)
+    timer.run("postprocess", postprocess)
+    return pd.DataFrame(timer.results).set_index("stage")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the stages of run.py on synthetic data")
+    parser.add_argument("--stations", type=int, default=3, help="number of stations to train (1-%s, any with --synthetic-registry)" % len(STATIONS))
+    parser.add_argument("--synthetic-registry", action="store_true", help="generate a registry of --stations synthetic stations")
+    parser.add_argument("--days", type=int, default=365, help="days of history before the test window")
+    parser.add_argument("--load-days", type=int, default=None, help="only load the last days of history (at least 57)")
+    parser.add_argument("--n-splines", type=int, default=4)
+    parser.add_argument("--lam", type=float, default=0.1)
+    parser.add_argument("--n-jobs", type=int, default=1)
+    parser.add_argument("--memory", action="store_true", help="trace the peak memory of each stage")
+    parser.add_argument("--data-folder", default=None, help="keep the synthetic data in this folder")
+    parser.add_argument("--output", default=None, help="dump the results to a json file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        data_folder = args.data_folder if args.data_folder is not None else tmp
+        registry = synthetic_registry(args.stations) if args.synthetic_registry else REGISTRY
+        make_synthetic_data(data_folder, days=args.days, registry=registry)
+        results = run_benchmark(data_folder, n_stations=args.stations, n_splines=args.n_splines, lam=args.lam,
+                                memory=args.memory, n_jobs=args.n_jobs, registry=registry, load_days=args.load_days)
+    print("="*20, "\nBenchmark: %s stations, %s days, n_splines=%s\n" % (args.stations, args.days, args.n_splines))
+    print(results, "\n", "="*20)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(args), "stages": results.reset_index().to_dict(orient="records")}, f, indent=2)
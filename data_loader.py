@@ -22,95 +22,252 @@ Provide functions of loading data
             - df_weather_{id}_hourly.csv
         - national_demand
             - demanddata_{year}.csv
+        - cache (created by load_data if cache is enabled)
+"""
+
+"""
+    The stations are described by a registry (json), by default `stations.json`:
+    {
+        "{STATION}": {
+            "phase": 1,                 # data of the station in the folder phase-{phase}
+            "weather": 7,               # id of df_weather_{id}_hourly.csv
+            "nearby": ["{STATION}"],    # stations whose load is used as a feature
+            "outlier_removal": true,    # apply load_outlier_removal
+            "n_times_std": 3,           # (optional) outlier bound of the station
+            "submission_key": "..."     # (optional) value of the station column of the template
+        },
+        ...
+    }
 """
 
 import os
+import re
+import json
+import numpy as np
 import pandas as pd
 
-STATIONS = ["BOURNVILLE CB 7", "BRADLEY STOKE CB 8", "STRATTON CB 4041", "BRIDPORT CB 306", "HEMYOCK CB 56_24", "PORTISHEAD ASHLANDS CB 4"]
+# sub folder of the data_folder storing the parsed csv files in parquet format
+CACHE_FOLDER = "cache"
+# rows per row group of the parquet cache (the row groups outside a date range are skipped)
+ROW_GROUP_SIZE = 2**14
+# rows per chunk when a date range is read from a csv file
+CHUNK_ROWS = 2**16
+
+# the weather and national demand of a date range [start, end) of the Training Data are loaded
+# from start - MARGIN (warm-up of the smoothing) to end + HORIZON + MARGIN (the test window follows the Training Data)
+MARGIN = pd.Timedelta(days=7)
+HORIZON = pd.Timedelta(days=56)
+
+REGISTRY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stations.json")
+
+def load_registry(path=REGISTRY_FILE):
+    with open(path) as f:
+        registry = json.load(f)
+    for station, entry in registry.items():
+        if "weather" not in entry:
+            raise ValueError("No weather id for station `%s` in %s" % (station, path))
+        entry.setdefault("phase", None)
+        entry.setdefault("nearby", [])
+        entry.setdefault("outlier_removal", False)
+        for nearby_station in entry["nearby"]:
+            if nearby_station not in registry:
+                raise ValueError("Unknown nearby station `%s` of `%s` in %s" % (nearby_station, station, path))
+    return registry
 
-WEATHERS = {"BOURNVILLE CB 7": 7, "BRADLEY STOKE CB 8": 8, "STRATTON CB 4041": 3,
-            "BRIDPORT CB 306": 6, "HEMYOCK CB 56_24": 5, "PORTISHEAD ASHLANDS CB 4": 8}
+# stations of the given phase, in the order of the registry
+def phase_stations(phase, registry=None):
+    registry = REGISTRY if registry is None else registry
+    return [station for station, entry in registry.items() if entry["phase"] == phase]
 
-def load_data(data_folder):
+# stations and the nearby stations they depend on, in the order of the registry
+def required_stations(stations, registry=None):
+    registry = REGISTRY if registry is None else registry
+    required = set(stations)
+    for station in stations:
+        required.update(registry[station]["nearby"])
+    return [station for station in registry if station in required]
+
+REGISTRY = load_registry()
+
+STATIONS = list(REGISTRY)
+
+WEATHERS = {station: entry["weather"] for station, entry in REGISTRY.items()}
+
+"""
+    load_data(data_folder, stations=[...], start="2021-06-01", end=None, weather_columns=[...])
+    - stations: only these stations and their nearby stations are loaded (default: all the registry)
+    - start/end: only the Training Data within [start, end) is loaded, and the weather and national
+      demand around it (see MARGIN/HORIZON), the national demand files outside are not read
+    - weather_columns: only these columns of the weather files are loaded (default: all)
+    With the cache, the rows and columns are filtered when reading the parquet files, otherwise
+    the csv files are read by chunks up to the end of the range.
+"""
+def load_data(data_folder, cache=True, registry=None, stations=None, start=None, end=None, weather_columns=None):
+    registry = REGISTRY if registry is None else registry
+    if stations is not None:
+        registry = {station: registry[station] for station in required_stations(stations, registry)}
+    start = None if start is None else pd.Timestamp(start)
+    end = None if end is None else pd.Timestamp(end)
+    feed_start = None if start is None else start - MARGIN
+    feed_end = None if end is None else end + HORIZON + MARGIN
+    cache_folder = os.path.join(data_folder, CACHE_FOLDER) if cache else None
     data_by_station = {}
     combined_load_by_station = {}
 
     # map station name
-    for station in STATIONS:
-        data_by_station[station] = {"Weather Data": WEATHERS[station]}
+    for station, entry in registry.items():
+        data_by_station[station] = {"Weather Data": entry["weather"]}
         combined_load_by_station[station] = {}
 
-    # load data by station
-    load_station_training_data(os.path.join(data_folder, "phase-%s" % 1), data_by_station)
-    load_station_training_data(os.path.join(data_folder, "phase-%s" % 2), data_by_station)
-    # combined load by station
-    load_station_combined_load(os.path.join(data_folder, "phase-%s" % 1), combined_load_by_station)
-    load_station_combined_load(os.path.join(data_folder, "phase-%s" % 2), combined_load_by_station)
+    # load data and combined load by station from the folder of each phase
+    for phase in sorted(set(entry["phase"] for entry in registry.values()), key=str):
+        load_station_training_data(os.path.join(data_folder, "phase-%s" % phase), data_by_station, cache_folder, start=start, end=end)
+        load_station_combined_load(os.path.join(data_folder, "phase-%s" % phase), combined_load_by_station, cache_folder)
 
     # weather data by station
     weather_folder = os.path.join(data_folder, "weather_data")
-    load_weather(weather_folder, data_by_station)
+    load_weather(weather_folder, data_by_station, cache_folder, start=feed_start, end=feed_end, columns=weather_columns)
 
     # national demand data
     nd_folder = os.path.join(data_folder, "national_demand")
-    national_demand = load_national_demand(nd_folder)
+    national_demand = load_national_demand(nd_folder, cache_folder=cache_folder, start=feed_start, end=feed_end)
 
     return data_by_station, combined_load_by_station, national_demand
 
-def load_station_training_data(load_folder, data_by_station):
+def load_station_training_data(load_folder, data_by_station, cache_folder=None, start=None, end=None):
     for file in os.listdir(load_folder):
         if "Training Data" not in file:
             continue
         for station, data in data_by_station.items():
-            if file.startswith(station.upper()) and "Training Data" not in data:
+            if file.startswith(station.upper() + " ") and "Training Data" not in data:
                 data_by_station[station]["Training Data"] = os.path.join(load_folder, file)
                 break
     for station, data in data_by_station.items():
         if "Training Data" not in data or type(data["Training Data"]) is not str:
             continue
         # Training Data
-        training = pd.read_csv(data["Training Data"])
-        training.drop('Unnamed: 0', axis=1, inplace=True)
-        # re-index
-        training.index = pd.to_datetime(training.time)
-        training.drop('time', axis=1, inplace=True)
-        if all(training.units == 9):    # if all data has units = 9 (i.e. data in MW)  
-            training.drop('units', axis=1, inplace=True)
-        else:
-            print(training.where(training.units!=9, inplace=True))
-        data_by_station[station]["Training Data"] = training
-
-def load_station_combined_load(load_folder, data_by_station):
+        data_by_station[station]["Training Data"] = cached_read(data["Training Data"], read_training_data, cache_folder, start=start, end=end)
+
+def read_training_data(path, start=None, end=None):
+    training = read_csv_range(path, "time", start, end, usecols=["time", "value", "units"])
+    if all(training.units == 9):    # if all data has units = 9 (i.e. data in MW)  
+        training.drop('units', axis=1, inplace=True)
+    else:
+        print(training.where(training.units!=9, inplace=True))
+    return training
+
+def load_station_combined_load(load_folder, data_by_station, cache_folder=None):
     for file in os.listdir(load_folder):
         if "Combined Load" not in file:
             continue
         for station, data in data_by_station.items():
-            if file.startswith(station.upper()) and "Combined Load" not in data:
+            if file.startswith(station.upper() + " ") and "Combined Load" not in data:
                 data_by_station[station]["Combined Load"] = os.path.join(load_folder, file)
                 break
     for station, data in data_by_station.items():
         if "Combined Load" not in data or type(data["Combined Load"]) is not str:
             continue
         # Combined Load
-        combined = pd.read_csv(data["Combined Load"])
-        # re-index
-        combined.index = pd.to_datetime(combined.time)
-        combined.drop('time', axis=1, inplace=True)
-        data_by_station[station]["Combined Load"] = combined
+        data_by_station[station]["Combined Load"] = cached_read(data["Combined Load"], read_combined_load, cache_folder)
+
+def read_combined_load(path):
+    return read_csv_range(path, "time")
 
-def load_weather(weather_folder, data_by_station):
+def load_weather(weather_folder, data_by_station, cache_folder=None, start=None, end=None, columns=None):
+    # stations sharing the same weather id share the same DataFrame
+    weather_by_id = {}
     for station, data in data_by_station.items():
         weather_station = data["Weather Data"]
-        weather = pd.read_csv(os.path.join(weather_folder, "df_weather_%s_hourly.csv" % weather_station))
-        # re-index
-        weather.index = pd.to_datetime(weather.datetime)
-        weather.drop('datetime', axis=1, inplace=True)
-        data_by_station[station]["Weather Data"] = weather
-
-def load_national_demand(nd_folder, years=[2019, 2020, 2021]):
-    national_demand = [pd.read_csv(os.path.join(nd_folder, "demanddata_%s.csv" % year)) for year in years]
-    # re-index
-    for i, nd in enumerate(national_demand):
-        national_demand[i].index = pd.date_range('%s-01-01' % years[i], '%s-01-01' % (years[i]+1), freq='30T', closed='left')
-    return pd.concat([nd.ENGLAND_WALES_DEMAND for nd in national_demand])
+        if weather_station not in weather_by_id:
+            weather_by_id[weather_station] = cached_read(os.path.join(weather_folder, "df_weather_%s_hourly.csv" % weather_station),
+                                                         read_weather, cache_folder, start=start, end=end, columns=columns)
+        data_by_station[station]["Weather Data"] = weather_by_id[weather_station]
+
+def read_weather(path, start=None, end=None, columns=None):
+    return read_csv_range(path, "datetime", start, end, usecols=None if columns is None else ["datetime"] + list(columns))
+
+# half-hourly national demand of the years overlapping [start, end), the files of the other years are not read
+def load_national_demand(nd_folder, years=[2019, 2020, 2021], cache_folder=None, start=None, end=None):
+    years = [year for year in sorted(years) if (start is None or year >= start.year) and (end is None or year <= end.year)]
+    if len(years) == 0:
+        return pd.Series([], index=pd.DatetimeIndex([]), name="ENGLAND_WALES_DEMAND", dtype=float)
+    values = np.concatenate([cached_read(os.path.join(nd_folder, "demanddata_%s.csv" % year), read_national_demand, cache_folder)
+                             .ENGLAND_WALES_DEMAND.to_numpy() for year in years])
+    # one index for the consecutive full years
+    first, last = pd.Timestamp('%s-01-01' % years[0]), pd.Timestamp('%s-01-01' % (years[-1]+1))
+    if years[-1] - years[0] + 1 != len(years) or len(values) != (last - first) / pd.Timedelta(minutes=30):
+        raise ValueError("National demand of the years %s: %s rows, consecutive full years of half-hourly data expected" % (years, len(values)))
+    index = pd.date_range(first, periods=len(values), freq='30T')
+    return pd.Series(values, index=index, name="ENGLAND_WALES_DEMAND")[_in_range(index, start, end)]
+
+def read_national_demand(path):
+    return pd.read_csv(path, usecols=["ENGLAND_WALES_DEMAND"])
+
+# rows of a csv file (sorted by time_col) within [start, end), indexed by time_col
+# with a date range, the file is read by chunks and the reading stops after end
+def read_csv_range(path, time_col, start=None, end=None, usecols=None):
+    if start is None and end is None:
+        chunks = [pd.read_csv(path, usecols=usecols)]
+    else:
+        chunks = pd.read_csv(path, usecols=usecols, chunksize=CHUNK_ROWS)
+    frames = []
+    for chunk in chunks:
+        chunk.index = pd.to_datetime(chunk.pop(time_col))
+        frames.append(chunk[_in_range(chunk.index, start, end)])
+        if end is not None and len(chunk) > 0 and chunk.index[-1] >= end:
+            break
+    return pd.concat(frames) if len(frames) > 1 else frames[0]
+
+def _in_range(index, start=None, end=None):
+    mask = np.ones(len(index), dtype=bool)
+    if start is not None:
+        mask &= index >= start
+    if end is not None:
+        mask &= index < end
+    return mask
+
+# read a csv file through `reader`, or load the parsed frame back from the parquet cache
+# the cache is keyed by the path of the csv file relative to the data folder (the parent of cache_folder),
+# e.g. `phase-1__{STATION} Training Data.{mtime}-{size}.parquet`, and invalidated when the modification
+# time or the size of the csv file changes
+# the whole file is cached, the rows within [start, end) and the columns are selected when reading the cache
+def cached_read(path, reader, cache_folder=None, start=None, end=None, columns=None):
+    kwargs = {key: value for key, value in [("start", start), ("end", end), ("columns", columns)] if value is not None}
+    if cache_folder is None:
+        return reader(path, **kwargs)
+    stat = os.stat(path)
+    name = _cache_name(path, cache_folder)
+    cache_file = os.path.join(cache_folder, "%s.%s-%s.parquet" % (name, stat.st_mtime_ns, stat.st_size))
+    if os.path.isfile(cache_file):
+        try:
+            return _read_parquet_range(cache_file, start, end, columns)
+        except Exception as e:
+            print("Failed to read cache %s: %s" % (cache_file, e))
+    df = reader(path)
+    try:
+        if not os.path.isdir(cache_folder):
+            os.makedirs(cache_folder)
+        # remove the outdated cache of the same csv file
+        outdated = re.compile(re.escape(name) + r"\.\d+-\d+\.parquet")
+        for file in os.listdir(cache_folder):
+            if outdated.fullmatch(file):
+                os.remove(os.path.join(cache_folder, file))
+        df.to_parquet(cache_file, row_group_size=ROW_GROUP_SIZE)
+    except Exception as e:  # e.g. pyarrow/fastparquet is not installed
+        print("Failed to cache %s: %s" % (path, e))
+    if columns is not None:
+        df = df[list(columns)]
+    return df[_in_range(df.index, start, end)] if start is not None or end is not None else df
+
+# path of the csv file relative to the parent of cache_folder, without extension, "__" between the folders
+def _cache_name(path, cache_folder):
+    relative = os.path.relpath(os.path.abspath(path), os.path.dirname(os.path.abspath(cache_folder)))
+    return os.path.splitext(relative)[0].replace(os.sep, "__")
+
+def _read_parquet_range(cache_file, start=None, end=None, columns=None):
+    if start is None and end is None:
+        return pd.read_parquet(cache_file, columns=None if columns is None else list(columns))
+    import pyarrow.parquet as pq
+    index_name = pq.read_schema(cache_file).pandas_metadata["index_columns"][0]
+    filters = ([(index_name, ">=", start)] if start is not None else []) + ([(index_name, "<", end)] if end is not None else [])
+    return pd.read_parquet(cache_file, columns=None if columns is None else list(columns), filters=filters)
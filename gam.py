@@ -4,10 +4,18 @@ Created on Sat Feb 19 07:23:00 2022
 @author: J Wang
 """
 
+import pickle
+import numpy as np
 import pandas as pd
+import scipy.sparse as sp
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pygam import GAM, te
+from pygam.pygam import EPS
 from sklearn.metrics import mean_absolute_percentage_error
 
+from instrument import RECORDER, stage
+from sparse_gam import SparseGAM
+
 Fixed_te_default = [['prev_2_mo', 'month', 'hour'],
                     ['month', 'hour', 'day'],
                     ['month', 'windspeed_north', 'windspeed_east']]
@@ -16,56 +24,300 @@ Nearby_te_default = [['prev_2_mo', 'national'],
                      ['month', 'hour'], 
                      ['doW_x', 'doW_y']]
 
-def initialise_gam(df, gam_params={"lam": 0.1}, te_params={"n_splines": 10}, num_fixed_col=12):
-    # num_fixed_col depends on the feature
-    # columns after num_fixed_col is the load of corresponding nearby stations
-    col_index = {col: i for i, col in enumerate(df.columns)}
-    tensor_terms = te(*[col_index[f] for f in Fixed_te_default[0]], **te_params)
+# features of the tensor terms of the GAM of the given columns
+# columns after num_fixed_col are the loads of the nearby stations, each adds len(Nearby_te_default) terms
+# without nearby station, 2 terms of the national demand are added instead
+def gam_terms(columns, num_fixed_col=12):
+    terms = [Fixed_te_default[0]]
     for features_comb in Fixed_te_default[1:-1]:
-        tensor_terms += te(*[col_index[f] for f in features_comb], **te_params)
+        terms.append(features_comb)
     # col starts from num_fixed_col stands for nearby stations
-    for col in df.columns[num_fixed_col:]:
+    for col in columns[num_fixed_col:]:
         te_flex = [[col] + features_comb for features_comb in Nearby_te_default[:-1]]
         for features_comb in te_flex:
-            tensor_terms += te(*[col_index[f] for f in features_comb], **te_params)
+            terms.append(features_comb)
 
     # If tensorterm is not in this order, the svd may fail to converge (don't know why)
     for features_comb in Fixed_te_default[-1:]:
-        tensor_terms += te(*[col_index[f] for f in features_comb], **te_params)
+        terms.append(features_comb)
     # col starts from num_fixed_col stands for nearby stations
-    for col in df.columns[num_fixed_col:]:
+    for col in columns[num_fixed_col:]:
         te_flex = [[col] + features_comb for features_comb in Nearby_te_default[-1:]]
         for features_comb in te_flex:
-            tensor_terms += te(*[col_index[f] for f in features_comb], **te_params)
+            terms.append(features_comb)
 
-    if num_fixed_col == len(df.columns):
+    if num_fixed_col == len(columns):
         te_flex = [['prev_2_mo', 'national'], ['national', 'doW_x', 'doW_y']]
         for features_comb in te_flex:
-            tensor_terms += te(*[col_index[f] for f in features_comb], **te_params)
-    gam = GAM(tensor_terms)
+            terms.append(features_comb)
+    return terms
+
+# backend: "pygam" or "sparse" (see `sparse_gam.py`), both with the same terms
+def initialise_gam(df, gam_params={"lam": 0.1}, te_params={"n_splines": 10}, num_fixed_col=12, backend="pygam"):
+    # num_fixed_col depends on the feature
+    # columns after num_fixed_col is the load of corresponding nearby stations
+    col_index = {col: i for i, col in enumerate(df.columns)}
+    terms = [[col_index[f] for f in features_comb] for features_comb in gam_terms(list(df.columns), num_fixed_col)]
+
+    if backend == "sparse":
+        gam = SparseGAM(terms, **te_params)
+    elif backend == "pygam":
+        tensor_terms = te(*terms[0], **te_params)
+        for features in terms[1:]:
+            tensor_terms += te(*features, **te_params)
+        gam = GAM(tensor_terms)
+    else:
+        raise ValueError("Unknown GAM backend `%s`" % backend)
     gam.set_params(**gam_params)
     return gam
 
-def train_gam(dataset_by_station, gam_params={"lam": 0.1}, te_params={"n_splines": 10},
-              num_fixed_col=12, return_fitted=False, return_test=True):
-    trained_gam = {}
-    for station, dataset in dataset_by_station.items():
-        train_df, test_df = dataset["train"], dataset["test"]
-        train_df, train_label = train_df[test_df.columns], train_df["target"]
-        gam = initialise_gam(train_df, gam_params=gam_params, te_params=te_params, num_fixed_col=num_fixed_col-1) # -1 due to the target column
+# compile the terms of the GAM (edge knots) on the rows of df without fitting it, as `fit` does before solving
+# (e.g. to solve its normal equations, see `sweep.py`)
+def compile_gam(gam, df):
+    X = np.asarray(df, dtype=np.float64)
+    if isinstance(gam, GAM):
+        gam._validate_params()
+        gam.statistics_ = {"m_features": X.shape[1]}
+    gam._validate_data_dep_params(X)
+    return gam
+
+def train_station(station, dataset, gam_params={"lam": 0.1}, te_params={"n_splines": 10},
+                  num_fixed_col=12, return_fitted=False, return_test=True, incremental=False,
+                  predict_memory_mb=None, predict_threads=1, backend="pygam", uncertainty=None, n_samples=200, seed=0):
+    # fit the GAM of a single station, run in a worker process when n_jobs > 1
+    train_df, test_df = dataset["train"], dataset["test"]
+    train_df, train_label = train_df[test_df.columns], train_df["target"]
+    gam = initialise_gam(train_df, gam_params=gam_params, te_params=te_params, num_fixed_col=num_fixed_col-1, backend=backend) # -1 due to the target column
+    with stage("fit", station):
         gam.fit(train_df, train_label)
-        fitted = run_test(gam, train_df)
-        train_mape = mean_absolute_percentage_error(train_label, fitted)
-        print(station, ' Train MAPE: ', train_mape)
-        trained_gam[station] = {"gam": gam, "train_mape": train_mape}
-        if return_fitted:
-            trained_gam[station]["fitted"] = fitted
+    with stage("predict_train", station):
+        fitted = run_test(gam, train_df, max_memory_mb=predict_memory_mb, n_threads=predict_threads)
+    train_mape = mean_absolute_percentage_error(train_label, fitted)
+    print(station, ' Train MAPE: ', train_mape)
+    result = {"gam": gam, "train_mape": train_mape, "columns": list(train_df.columns), "last_index": train_df.index[-1]}
+    if incremental:
+        with stage("normal_equations", station):
+            result["normal_eq"] = normal_equations(gam, train_df, train_label)
+        result["overlap"] = dataset["train"][dataset["train"].index > result["last_index"] - UPDATE_OVERLAP]
+    if return_fitted:
+        result["fitted"] = fitted
+    if return_test:
+        with stage("predict_test", station):
+            result["test_result"] = run_test(gam, test_df, max_memory_mb=predict_memory_mb, n_threads=predict_threads)
+    if uncertainty is not None:
+        result["uncertainty"] = {"method": uncertainty, "n_samples": n_samples, "seed": seed}
+        result["residuals"] = train_label - fitted
         if return_test:
-            trained_gam[station]["test_result"] = run_test(gam, test_df)
+            with stage("predict_samples", station):
+                result["test_samples"] = prediction_samples(gam, test_df, result["test_result"], result["residuals"], **result["uncertainty"])
+    return result
+
+# train a station in a worker process, the stages recorded in the worker are sent back with the result
+def _train_station_worker(station, dataset, record, params):
+    RECORDER.enabled, RECORDER.records = record, []
+    result = train_station(station, dataset, **params)
+    return result, RECORDER.records
+
+def train_gam(dataset_by_station, gam_params={"lam": 0.1}, te_params={"n_splines": 10},
+              num_fixed_col=12, return_fitted=False, return_test=True, n_jobs=1, incremental=False,
+              predict_memory_mb=None, predict_threads=1, backend="pygam", uncertainty=None, n_samples=200, seed=0):
+    # n_jobs > 1 fits the stations in separate processes (None uses all cores)
+    # incremental keeps the normal equations of the fit so that the model can be updated by `update_gam`
+    # predict_memory_mb bounds the memory of the model matrix when predicting (see `iter_predict`), not of the predictions
+    # backend "sparse" fits the same terms with sparse bases and a direct solver (see `sparse_gam.py`)
+    # uncertainty "bootstrap" or "covariance" adds n_samples sample paths of the test prediction (see `prediction_samples`)
+    params = {"gam_params": gam_params, "te_params": te_params, "num_fixed_col": num_fixed_col,
+              "return_fitted": return_fitted, "return_test": return_test, "incremental": incremental,
+              "predict_memory_mb": predict_memory_mb, "predict_threads": predict_threads, "backend": backend,
+              "uncertainty": uncertainty, "n_samples": n_samples, "seed": seed}
+    trained_gam = {}
+    if n_jobs == 1 or len(dataset_by_station) < 2:
+        for station, dataset in dataset_by_station.items():
+            trained_gam[station] = train_station(station, dataset, **params)
+        return trained_gam
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        futures = {station: executor.submit(_train_station_worker, station, dataset, RECORDER.enabled, params)
+                   for station, dataset in dataset_by_station.items()}
+        # keep the order of dataset_by_station
+        for station, future in futures.items():
+            trained_gam[station], records = future.result()
+            RECORDER.records.extend(records)
     return trained_gam
 
-def run_test(gam, df):
+def run_test(gam, df, max_memory_mb=None, n_threads=1):
+    if max_memory_mb is not None and len(df) > predict_chunk_size(gam, max_memory_mb):
+        return pd.concat(list(iter_predict(gam, df, max_memory_mb=max_memory_mb, n_threads=n_threads)))
     result = gam.predict(df)
     result = pd.Series(result, index = df.index)
     return result
 
+# number of rows whose model matrix fits in max_memory_mb
+# (pygam builds each tensor term densely, i.e. 8 bytes per coefficient per row)
+def predict_chunk_size(gam, max_memory_mb):
+    return max(1, int(max_memory_mb * 2**20 / (8 * len(gam.coef_))))
+
+# predict df in row blocks and yield one pd.Series per block
+# the peak memory of the model matrix is bounded by n_threads blocks of max_memory_mb, independent of len(df)
+# (the predictions themselves, 8 bytes per row, are concatenated by `run_test`)
+def iter_predict(gam, df, max_memory_mb=256, n_threads=1):
+    chunk_size = predict_chunk_size(gam, max_memory_mb)
+    chunks = (df.iloc[i:i+chunk_size] for i in range(0, len(df), chunk_size))
+    if n_threads == 1:
+        for chunk in chunks:
+            yield run_test(gam, chunk)
+        return
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        # map keeps the order of the blocks
+        yield from executor.map(lambda chunk: run_test(gam, chunk), chunks)
+
+"""
+Incremental training
+
+For the identity link and normal distribution, PIRLS converges in one step to the
+penalized least squares solution
+
+    (X'X + P + sqrt(EPS) I) b = X'y
+
+where X is the model matrix (spline basis) and P the penalty matrix of the GAM.
+X'X and X'y are sums over the rows, so new rows are added to the stored normal
+equations and the coefficients are re-solved without revisiting the history.
+X'X is stored as the sparse upper triangle (the tensor bases are local, most pairs of
+coefficients share no row), and densified only to be solved.
+
+The last UPDATE_OVERLAP of the rows seen by the model are kept with it: their target and
+features change once newer data arrives (centred smoothing of the load and the national
+demand), so their old contribution is subtracted and the new one added. The rest of the
+rows is unchanged provided the load is pre-processed with the outlier bounds of the
+initial fit (see `run.py`). The spline knots are kept from the initial fit (new values
+are extrapolated). The covariance, scale and degrees of freedom of `gam.statistics_` and
+the residuals are recomputed after the update, the other statistics are dropped.
+"""
+# rows before the last row seen by the model that are recomputed by `update_gam`
+UPDATE_OVERLAP = pd.Timedelta(days=1)
+
+def normal_equations(gam, df, label):
+    modelmat = gam._modelmat(df)
+    label = np.asarray(label, dtype=float)
+    return {"XtX": sp.triu(modelmat.T.dot(modelmat), format="csr"), "Xty": modelmat.T.dot(label),
+            "yty": label.dot(label), "n_rows": len(df)}
+
+# dense X'X + P + sqrt(EPS) I from the upper triangle of X'X
+def penalized_normal_matrix(gam, normal_eq, P=None):
+    P = gam._P() if P is None else P
+    XtX = normal_eq["XtX"]
+    return (XtX + XtX.T - sp.diags(XtX.diagonal()) + P).A + np.sqrt(EPS) * np.eye(len(normal_eq["Xty"]))
+
+def solve_normal_equations(gam, normal_eq, P=None):
+    return np.linalg.solve(penalized_normal_matrix(gam, normal_eq, P=P), normal_eq["Xty"])
+
+# statistics of the penalized least squares solution, as computed by pygam for the normal distribution
+# A = X'X + P + sqrt(EPS) I is inverted on its eigenvectors, without the directions held by the sqrt(EPS)
+# ridge only (no data and no penalty), whose inverse is rounding noise and breaks the covariance;
+# pygam's covariance is A^-1 X'X A^-1 (B B' with B = A^-1 X')
+def normal_equations_statistics(gam, normal_eq):
+    XtX = normal_eq["XtX"]
+    XtX = XtX + XtX.T - sp.diags(XtX.diagonal())
+    eigenvalues, eigenvectors = np.linalg.eigh(penalized_normal_matrix(gam, normal_eq))
+    keep = eigenvalues > 2 * np.sqrt(EPS)
+    V, V_scaled = eigenvectors[:, keep], eigenvectors[:, keep] / eigenvalues[keep]
+    VtXtX = np.asarray(XtX.dot(V)).T
+    # diagonal of A^-1 X'X
+    edof_per_coef = np.einsum("ij,ji->i", V_scaled, VtXtX)
+    rss = normal_eq["yty"] - 2 * gam.coef_.dot(normal_eq["Xty"]) + gam.coef_.dot(XtX.dot(gam.coef_))
+    scale = rss / (normal_eq["n_rows"] - edof_per_coef.sum())
+    cov = V_scaled.dot(VtXtX.dot(V)).dot(V_scaled.T) * scale
+    cov = (cov + cov.T) / 2
+    return {"edof_per_coef": edof_per_coef, "edof": edof_per_coef.sum(), "scale": scale,
+            "cov": cov, "se": np.sqrt(cov.diagonal()), "n_samples": normal_eq["n_rows"]}
+
+def update_gam(trained_gam, dataset_by_station, return_test=True):
+    # the training rows after the last row seen by the model are added, the rows of the overlap are recomputed
+    for station, dataset in dataset_by_station.items():
+        if station not in trained_gam or "normal_eq" not in trained_gam[station]:
+            print(station, " has no incremental model, train it with `incremental=True` first")
+            continue
+        result = trained_gam[station]
+        train_df, test_df = dataset["train"], dataset["test"]
+        n_new = (train_df.index > result["last_index"]).sum()
+        if n_new > 0:
+            gam, normal_eq, old = result["gam"], result["normal_eq"], result["overlap"]
+            new_df = train_df[train_df.index > result["last_index"] - UPDATE_OVERLAP]
+            old_eq = normal_equations(gam, old[result["columns"]], old["target"])
+            new_eq = normal_equations(gam, new_df[result["columns"]], new_df["target"])
+            for key in normal_eq:
+                normal_eq[key] = normal_eq[key] - old_eq[key] + new_eq[key]
+            with stage("update", station):
+                gam.coef_ = solve_normal_equations(gam, normal_eq)
+            if hasattr(gam, "statistics_"):
+                gam.statistics_ = {"m_features": gam.statistics_["m_features"], **normal_equations_statistics(gam, normal_eq)}
+                gam.distribution.scale = gam.statistics_["scale"]
+            result["last_index"] = train_df.index[-1]
+            result["overlap"] = train_df[train_df.index > result["last_index"] - UPDATE_OVERLAP]
+            if "residuals" in result:
+                result["residuals"] = train_df["target"] - run_test(gam, train_df[result["columns"]])
+        print(station, ' Updated with %s new rows' % n_new)
+        if return_test:
+            result["test_result"] = run_test(result["gam"], test_df[result["columns"]])
+            if "uncertainty" in result:
+                result["test_samples"] = prediction_samples(result["gam"], test_df[result["columns"]], result["test_result"],
+                                                            result["residuals"], **result["uncertainty"])
+    return trained_gam
+
+"""
+Uncertainty of the predictions
+
+The post-processing takes the daily max of (combined load - prediction), so an interval of
+the daily EV peak can not be derived from the intervals of each prediction: sample paths of
+the prediction are drawn instead and post-processed in one batch (see
+`postprocess.generate_prediction`), from the fitted GAM without refitting it:
+    - "bootstrap": the residuals of the training set are resampled by whole days (the
+      residuals of a random training day at the same times of the day), which keeps their
+      correlation within the day, and added to the prediction
+    - "covariance": the coefficients are drawn from their normal approximation (coef_ and
+      statistics_["cov"] of pygam, as in `GAM.prediction_intervals`), plus the residuals of
+      random whole training days as in "bootstrap", pygam backend only
+The noise is drawn by whole days: independent noise at each 15-minute step would raise the
+daily max of the samples above the daily max of the prediction (the residuals are
+correlated within the day). The output is an array of shape (n_samples, len(df)).
+"""
+def prediction_samples(gam, df, prediction, residuals, method="bootstrap", n_samples=200, seed=0):
+    rng = np.random.default_rng(seed)
+    if method == "bootstrap":
+        return np.asarray(prediction, dtype=float) + residual_bootstrap(residuals, df.index, n_samples=n_samples, rng=rng)
+    if method == "covariance":
+        if not hasattr(gam, "statistics_"):
+            raise ValueError("Covariance samples require the pygam backend")
+        # cholesky is much faster than the default svd for thousands of coefficients
+        try:
+            coefs = rng.multivariate_normal(gam.coef_, gam.statistics_["cov"], size=n_samples, method="cholesky")
+        except np.linalg.LinAlgError:
+            coefs = rng.multivariate_normal(gam.coef_, gam.statistics_["cov"], size=n_samples, method="eigh")
+        noise = residual_bootstrap(residuals, df.index, n_samples=n_samples, rng=rng)
+        return np.asarray(gam._modelmat(df).dot(coefs.T)).T + noise
+    raise ValueError("Unknown uncertainty method `%s`" % method)
+
+# residuals of random whole training days at the times of the day of index, shape (n_samples, len(index))
+def residual_bootstrap(residuals, index, n_samples=200, rng=None):
+    rng = np.random.default_rng(0) if rng is None else rng
+    steps = _step_of_day(index)
+    residual_days, residual_day = np.unique(residuals.index.floor('D'), return_inverse=True)
+    grid = np.full((len(residual_days), 96), np.nan)
+    grid[residual_day, _step_of_day(residuals.index)] = residuals.to_numpy()
+    # the training days with a residual at all the times of the day of index
+    grid = grid[~np.isnan(grid[:, np.unique(steps)]).any(axis=1)]
+    if len(grid) == 0:
+        raise ValueError("No training day has residuals at all the times of the prediction")
+    _, day = np.unique(index.floor('D'), return_inverse=True)
+    drawn = rng.integers(len(grid), size=(n_samples, day.max() + 1))
+    return grid[drawn[:, day], steps]
+
+def _step_of_day(index):
+    return np.asarray((index - index.floor('D')) // pd.Timedelta(minutes=15), dtype=int)
+
+def save_trained_gam(trained_gam, path):
+    with open(path, "wb") as f:
+        pickle.dump(trained_gam, f)
+
+def load_trained_gam(path):
+    with open(path, "rb") as f:
+        return pickle.load(f)
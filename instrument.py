@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Mar 13 09:10:00 2022
+@author: WOJJ
+
+Provide per-stage timing and memory instrumentation
+
+    from instrument import RECORDER, stage
+    RECORDER.enabled = True
+    with stage("pack_dataset"):
+        ...
+    with stage("fit", station="BOURNVILLE CB 7"):
+        ...
+    RECORDER.dump("profile.json")
+
+Each stage records its wall time, CPU time and memory:
+    - process_peak_rss_mb: the peak resident set size (RSS) of the process since it started
+      (ru_maxrss), not of the stage: a worker process reused for several stations reports
+      the largest peak of all the stages it has run so far
+    - process_peak_growth_mb: the growth of that peak during the stage, 0 when the stage stays
+      below an earlier peak of the process
+    - rss_delta_mb: the change of the current RSS during the stage, i.e. the memory kept by
+      the stage (Linux only)
+The recorder is disabled by default, in which case `stage` costs nothing.
+"""
+
+import os
+import sys
+import json
+import time
+from functools import wraps
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+# peak RSS of the current process since it started in MB (None if unknown)
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+# current RSS of the current process in MB (None if unknown)
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+class StageRecorder:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.records = []
+
+    @contextmanager
+    def stage(self, name, station=None):
+        if not self.enabled:
+            yield
+            return
+        peak, rss = peak_rss_mb(), current_rss_mb()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            record = {"stage": name, "station": station,
+                      "wall_s": time.perf_counter() - wall, "cpu_s": time.process_time() - cpu,
+                      "process_peak_rss_mb": peak_rss_mb(), "pid": os.getpid()}
+            record["process_peak_growth_mb"] = None if peak is None else record["process_peak_rss_mb"] - peak
+            end_rss = current_rss_mb()
+            record["rss_delta_mb"] = None if rss is None or end_rss is None else end_rss - rss
+            self.records.append(record)
+
+    # decorator version of `stage`
+    def timed(self, name):
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    # total wall/cpu time, max process peak RSS and max peak growth of each stage (over stations)
+    def summary(self):
+        summary = {}
+        for record in self.records:
+            s = summary.setdefault(record["stage"], {"count": 0, "wall_s": 0., "cpu_s": 0.,
+                                                     "process_peak_rss_mb": None, "process_peak_growth_mb": None})
+            s["count"] += 1
+            s["wall_s"] += record["wall_s"]
+            s["cpu_s"] += record["cpu_s"]
+            for key in ["process_peak_rss_mb", "process_peak_growth_mb"]:
+                if record[key] is not None:
+                    s[key] = max(s[key] or 0., record[key])
+        return summary
+
+    def dump(self, path):
+        folder = os.path.dirname(path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        with open(path, "w") as f:
+            json.dump({"summary": self.summary(), "records": self.records}, f, indent=2)
+        print("Profile dumped to:", path)
+
+# recorder shared by the modules of the workflow
+RECORDER = StageRecorder()
+
+def stage(name, station=None):
+    return RECORDER.stage(name, station=station)
+
+def timed(name):
+    return RECORDER.timed(name)
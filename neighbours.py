@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Mar 15 09:40:00 2022
+@author: WOJJ
+
+Provide the automatic selection of the nearby stations
+"""
+
+"""
+The load of a nearby station is used as a feature of the station together with its own
+load of 56 days ago, and each nearby station adds tensor terms to the GAM (see
+`gam.gam_terms`: the first one replaces the 2 terms of the national demand used without
+nearby station), so the fit time grows with the number of nearby stations.
+
+Correlation index:
+    The (smoothed) Training Data of all the stations are aligned on one time index, and the
+    Pearson correlation between the load of each station at t and the load of every other
+    station at t - lag is computed for all the pairs at once (matrix products over the
+    rows where both are known), for each lag of `lags`:
+
+        index["corr"][l, i, j] = corr(load_i(t), load_j(t - lags[l]))
+
+    The index is cached in the cache folder, keyed by a hash of the loads and the lags.
+
+Selection:
+    The neighbours of each station are ranked by the absolute correlation at the lag used
+    by `pack_dataset` (LAG_STEPS). At most k neighbours per station are kept, and with a
+    term budget the (station, neighbour) pairs are added by decreasing correlation as long
+    as the terms they add (counted by `nearby_term_cost`) fit in the budget. Any station can be selected: `pack_dataset`
+    aligns the load of a nearby station on the times of the station (rows where it is
+    missing are dropped).
+
+Tradeoff report:
+    For each k, the GAM of each station is fitted on its training data except the last
+    VALIDATION_DAYS, and the fit time, number of terms and held-out MAPE are reported.
+"""
+
+import os
+import time
+import hashlib
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.metrics import mean_absolute_percentage_error
+
+from data_loader import REGISTRY
+from preprocess import pack_dataset, LAG_STEPS, FeatureStore
+from gam import initialise_gam, gam_terms
+from sweep import VALIDATION_DAYS
+
+# tensor terms added to the GAM of a station with n_nearby nearby stations by one more nearby station
+def nearby_term_cost(n_nearby, num_fixed_col=11):
+    columns = ["feature_%s" % i for i in range(num_fixed_col)] + ["nearby_%s" % i for i in range(n_nearby + 1)]
+    return len(gam_terms(columns, num_fixed_col)) - len(gam_terms(columns[:-1], num_fixed_col))
+
+# lagged correlation between the loads of all the stations, cached in cache_folder if given
+def correlation_index(data_by_station, lags=(0, LAG_STEPS), cache_folder=None):
+    stations = list(data_by_station)
+    loads = pd.concat([_load_series(data_by_station[station]) for station in stations], axis=1)
+    values = loads.to_numpy(dtype=np.float64)
+    cache_file = None
+    if cache_folder is not None:
+        key = hashlib.sha1(values.tobytes() + np.asarray(lags, dtype=np.int64).tobytes()
+                           + "|".join(stations).encode()).hexdigest()[:16]
+        cache_file = os.path.join(cache_folder, "correlation_%s.npz" % key)
+        if os.path.isfile(cache_file):
+            with np.load(cache_file) as cached:
+                return {"stations": stations, "lags": list(lags), "corr": cached["corr"], "count": cached["count"]}
+    corr = np.empty((len(lags), len(stations), len(stations)))
+    count = np.empty((len(lags), len(stations), len(stations)), dtype=np.int64)
+    for l, lag in enumerate(lags):
+        corr[l], count[l] = lagged_correlation(values, lag)
+    if cache_file is not None:
+        os.makedirs(cache_folder, exist_ok=True)
+        np.savez(cache_file, corr=corr, count=count)
+    return {"stations": stations, "lags": list(lags), "corr": corr, "count": count}
+
+# correlation of column i at t with column j at t - lag for all (i, j), over the rows where both are not NaN
+def lagged_correlation(values, lag=0):
+    # centre the columns to limit the cancellation in the sums
+    values = values - np.nanmean(values, axis=0)
+    a, b = (values[lag:], values[:len(values)-lag]) if lag > 0 else (values, values)
+    mask_a, mask_b = (~np.isnan(a)).astype(np.float64), (~np.isnan(b)).astype(np.float64)
+    a, b = np.nan_to_num(a), np.nan_to_num(b)
+    n = mask_a.T @ mask_b
+    sum_a, sum_b = a.T @ mask_b, mask_a.T @ b
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cov = a.T @ b - sum_a * sum_b / n
+        var_a = (a**2).T @ mask_b - sum_a**2 / n
+        var_b = mask_a.T @ b**2 - sum_b**2 / n
+        corr = cov / np.sqrt(var_a * var_b)
+    corr[n < 2] = np.nan
+    return corr, n.astype(np.int64)
+
+# nearby stations of each station: top-k by correlation, under a budget of extra terms over all the stations
+def select_nearby(index, stations=None, k=2, term_budget=None, lag=LAG_STEPS, min_corr=0.):
+    stations = index["stations"] if stations is None else stations
+    corr = np.abs(index["corr"][index["lags"].index(lag)])
+    position = {station: i for i, station in enumerate(index["stations"])}
+    candidates = []
+    for station in stations:
+        scores = corr[position[station]].copy()
+        scores[position[station]] = np.nan
+        ranked = [j for j in np.argsort(-np.nan_to_num(scores, nan=-np.inf)) if scores[j] > min_corr][:k]
+        candidates += [(scores[j], station, index["stations"][j]) for j in ranked]
+    nearby = {station: [] for station in stations}
+    for score, station, nearby_station in sorted(candidates, key=lambda candidate: -candidate[0]):
+        if term_budget is not None:
+            cost = nearby_term_cost(len(nearby[station]))
+            if cost > term_budget:
+                continue
+            term_budget -= cost
+        nearby[station].append(nearby_station)
+    return nearby
+
+# copy of the registry with the nearby stations replaced
+def with_nearby(nearby, registry=None):
+    registry = REGISTRY if registry is None else registry
+    return {station: dict(entry, nearby=nearby.get(station, entry["nearby"])) for station, entry in registry.items()}
+
+"""
+The output of the tradeoff report is a pandas.DataFrame object:
+
+                        k-0                         ...     k-2
+                        fit_s   n_terms   mape      ...     fit_s   n_terms   mape
+station_1               ...
+overall                 sum     sum       mean      ...
+"""
+def nearby_tradeoff(data_by_station, national_demand, stations, index, ks=(0, 1, 2), registry=None,
+                    gam_params={"lam": 0.1}, te_params={"n_splines": 10}, input_smoothed=False, n_jobs=1):
+    tasks = []
+    # the features shared by the stations are computed once for all the k
+    store = FeatureStore.from_stations(data_by_station, national_demand, stations, registry)
+    for k in ks:
+        nearby = select_nearby(index, stations, k=k)
+        dataset_by_station = pack_dataset(data_by_station, national_demand, stations, input_smoothed=input_smoothed,
+                                          registry=with_nearby(nearby, registry), store=store)
+        tasks += [(station, dataset_by_station[station], gam_params, te_params) for station in stations]
+    if n_jobs == 1:
+        results = [tradeoff_station(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(tradeoff_station, *zip(*tasks)))
+
+    columns = pd.MultiIndex.from_product([["k-%s" % k for k in ks], ["fit_s", "n_terms", "mape"]])
+    report = pd.DataFrame(index=stations, columns=columns, dtype=float)
+    for i, result in enumerate(results):
+        k, station = ks[i // len(stations)], stations[i % len(stations)]
+        for name, value in result.items():
+            report.loc[station, ("k-%s" % k, name)] = value
+    overall = report.sum(axis=0)
+    overall.loc[(slice(None), "mape")] = report.loc[:, (slice(None), "mape")].mean(axis=0)
+    report.loc["overall"] = overall
+    print("="*20, "\nFit time / held-out MAPE by number of nearby stations\n")
+    print(report, "\n", "="*20)
+    return report
+
+# fit time, number of terms and held-out MAPE of one station
+def tradeoff_station(station, dataset, gam_params={"lam": 0.1}, te_params={"n_splines": 10}, num_fixed_col=12):
+    train_df, test_df = dataset["train"], dataset["test"]
+    train_df, train_label = train_df[test_df.columns], train_df["target"]
+    split = train_df.index > train_df.index[-1] - pd.Timedelta(days=VALIDATION_DAYS)
+    gam = initialise_gam(train_df, gam_params=gam_params, te_params=te_params, num_fixed_col=num_fixed_col-1) # -1 due to the target column
+    fit_s = time.perf_counter()
+    gam.fit(train_df[~split], train_label[~split])
+    fit_s = time.perf_counter() - fit_s
+    mape = mean_absolute_percentage_error(train_label[split], gam.predict(train_df[split]))
+    return {"fit_s": fit_s, "n_terms": len(gam.terms) - 1, "mape": mape} # -1 due to the intercept
+
+# load of a station before (DataFrame) or after (Series) the pre-processing
+def _load_series(data):
+    load = data["Training Data"]
+    return load.value if isinstance(load, pd.DataFrame) else load
@@ -7,13 +7,13 @@ Provide functions of post-processing output of gam
 """
 
 import os
+import warnings
 import numpy as np
 import pandas as pd
 from datetime import datetime
-from sklearn.metrics import mean_squared_error
 
-from data_loader import STATIONS
-from preprocess import avgeraged_smoothing, weighted_smoothing
+from data_loader import REGISTRY, phase_stations
+from preprocess import smooth
 
 # functions of calculating daily max based on combined load and hourly prediction
 # apply different methods on given combined loads to incorporate more information
@@ -36,31 +36,159 @@ def averaged_smoothed_max(c, p, ws):
     if ws is None or ws < 1:
         print("window size set to 13 by default")
         ws = 13
-    return daily_max(avgeraged_smoothing(c, ws=ws).value, p)
+    return daily_max(pd.Series(smooth(c.to_numpy(), ws, method="averaged"), index=c.index), p)
 
 def weighted_smoothed_max(c, p, ws):
     if ws is None or ws < 1:
         print("window size set to 13 by default")
         ws = 13
-    return daily_max(weighted_smoothing(c, ws=ws).value, p)
+    return daily_max(pd.Series(smooth(c.to_numpy(), ws, method="weighted"), index=c.index), p)
+
+"""
+Vectorized evaluation of the post-processing methods
+
+The combined load and the prediction are aligned once on a (days x 96) grid of
+15-minute intervals (NaN where a series has no value), then all the candidates
+(method, ws) are computed with NumPy reductions along the intervals of each day:
+    - daily_max: max of (c - p) over the 96 intervals
+    - hourly_mean/hourly_max: mean/max of c over the 4 intervals of each hour,
+      minus p at the hour, then max over the 24 hours
+    - averaged/weighted_smoothed_max: c smoothed for all the window sizes at once
+      (see `preprocess.smooth`), then daily max
+The result is the same as calling the methods one by one. The prediction values may
+have leading batch dimensions, e.g. (n_samples, len(p)), which are kept in the output.
+If the series are not on the 15-minute grid, the methods are called one by one.
+"""
+STEPS_PER_DAY = 96
+SMOOTHING_KERNELS = {"averaged_smoothed_max": "averaged", "weighted_smoothed_max": "weighted"}
+
+def evaluate_candidates(c, p, candidates, p_values=None):
+    p_values = p.to_numpy() if p_values is None else np.asarray(p_values)
+    grid = _daily_grid(c, p.index)
+    if grid is None:
+        if p_values.ndim > 1:
+            raise ValueError("Batched predictions require the 15-minute grid")
+        return {key: globals()[method](c, p, ws=ws) for key, (method, ws) in _candidate_keys(candidates).items()}
+    days, c_pos, p_pos = grid
+    n = len(days) * STEPS_PER_DAY
+    c_grid = np.full(n, np.nan)
+    c_grid[c_pos] = c.to_numpy()
+    p_grid = np.full(p_values.shape[:-1] + (n,), np.nan)
+    p_grid[..., p_pos] = p_values
+    c_grid, p_grid = c_grid.reshape(-1, STEPS_PER_DAY), p_grid.reshape(p_grid.shape[:-1] + (-1, STEPS_PER_DAY))
+    # hourly values of c and p at the hour (4 intervals per hour)
+    c_hours = c_grid.reshape(len(days), 24, -1)
+    p_hours = p_grid.reshape(p_grid.shape[:-1] + (24, -1))[..., 0]
+    count = np.sum(~np.isnan(c_hours), axis=-1)
+    with np.errstate(invalid="ignore"):
+        hourly = {"hourly_mean": np.where(count > 0, np.nansum(c_hours, axis=-1) / count, np.nan),
+                  "hourly_max": np.fmax.reduce(c_hours, axis=-1)}
+    # smoothed c of all the window sizes of each kernel in one pass
+    smoothed = {}
+    for method, kernel in SMOOTHING_KERNELS.items():
+        ws_list = sorted(set(_default_ws(ws) for (m, ws) in candidates if m == method))
+        if len(ws_list) > 0:
+            values = np.full((len(ws_list), n), np.nan)
+            values[:, c_pos] = smooth(c.to_numpy(), ws_list, method=kernel)
+            smoothed.update({(method, ws): values[i].reshape(-1, STEPS_PER_DAY) for i, ws in enumerate(ws_list)})
+    results = {}
+    for key, (method, ws) in _candidate_keys(candidates).items():
+        if method == "daily_max":
+            daily = np.fmax.reduce(c_grid - p_grid, axis=-1)
+        elif method in hourly:
+            daily = np.fmax.reduce(hourly[method] - p_hours, axis=-1)
+        elif method in SMOOTHING_KERNELS:
+            daily = np.fmax.reduce(smoothed[(method, _default_ws(ws))] - p_grid, axis=-1)
+        else:
+            raise ValueError("Unknown post-process method `%s`" % method)
+        results[key] = pd.Series(daily, index=days) if daily.ndim == 1 else daily
+    return results
+
+# key of each candidate, e.g. "daily_max" or "averaged_smoothed_max-13"
+def _candidate_keys(candidates):
+    return {method if ws is None else "%s-%s" % (method, ws): (method, ws) for (method, ws) in candidates}
+
+# window size used by the smoothed methods when ws is not given
+def _default_ws(ws):
+    return 13 if ws is None or ws < 1 else ws
+
+# days covered by c and p, and the positions of their values on the (days x 96) grid
+def _daily_grid(c, p_index):
+    index = c.index.union(p_index)
+    if len(index) == 0 or not c.index.is_unique or not p_index.is_unique:
+        return None
+    day0 = index[0].floor('D')
+    days = pd.date_range(day0, index[-1].floor('D'), freq='D')
+    positions = []
+    for idx in [c.index, p_index]:
+        steps = (idx - day0) / pd.Timedelta(minutes=15)
+        if not np.all(steps == np.round(steps)):
+            return None
+        positions.append(np.asarray(steps).astype(int))
+    return days, positions[0], positions[1]
 
 # generate prediction by given smoothing methods and prediction
-def generate_prediction(trained_gam, combined_load_by_station, method="averaged_smoothed_max", ws=None, save_key="prediction"):
+# with sample paths of the prediction (`gam.prediction_samples`), the quantiles of the post-processed
+# samples are saved as the lower and upper bounds (save_key + "_lower", save_key + "_upper")
+def generate_prediction(trained_gam, combined_load_by_station, method="averaged_smoothed_max", ws=None, save_key="prediction",
+                        quantiles=(0.05, 0.95)):
     if method not in globals():
         print("Unknown post-process method `%s`, switching to default: `averaged_smoothed_max, ws=13`" % method)
         method, ws = "averaged_smoothed_max", 13
     for station, result in trained_gam.items():
         test_result = result["test_result"]
-        trained_gam[station][save_key] = globals()[method](combined_load_by_station[station]["Combined Load"].value, test_result, ws=ws)
+        c = combined_load_by_station[station]["Combined Load"].value
+        trained_gam[station][save_key] = globals()[method](c, test_result, ws=ws)
+        if "test_samples" in result:
+            # all the samples are post-processed in one vectorized pass
+            daily = list(evaluate_candidates(c, test_result, [(method, ws)], p_values=result["test_samples"]).values())[0]
+            with warnings.catch_warnings():
+                # days without combined load
+                warnings.simplefilter("ignore", category=RuntimeWarning)
+                lower, upper = np.nanquantile(daily, quantiles, axis=0)
+            index = trained_gam[station][save_key].index
+            trained_gam[station][save_key + "_lower"] = pd.Series(lower, index=index)
+            trained_gam[station][save_key + "_upper"] = pd.Series(upper, index=index)
     
-def generate_submission(trained_gam, phase, data_folder, output_path, apply_abs=True):
-    stations = STATIONS[(phase-1)*3:phase*3]
+"""
+Rows of each station in the template/solution csv of a phase
+If the csv has a `station` column, the rows of a station are those whose station is
+its `submission_key` in the registry (the station name by default). Otherwise the
+stations are stacked in the order of the registry, each with one row per day of its
+prediction.
+"""
+def station_rows(table, stations, n_rows_by_station, registry=None):
+    registry = REGISTRY if registry is None else registry
+    rows = {}
+    if "station" in table.columns:
+        for station in stations:
+            key = registry[station].get("submission_key", station)
+            rows[station] = np.flatnonzero((table.station == key).to_numpy())
+    else:
+        start = 0
+        for station in stations:
+            rows[station] = np.arange(start, start + n_rows_by_station[station])
+            start += n_rows_by_station[station]
+        if start != len(table):
+            raise ValueError("%s rows expected for stations %s, got %s" % (start, stations, len(table)))
+    return rows
+
+def generate_submission(trained_gam, phase, data_folder, output_path, apply_abs=True, registry=None):
+    stations = phase_stations(phase, registry)
     template = pd.read_csv(os.path.join(data_folder, "phase-%s" % phase, "template_%s.csv" % phase))
-    template.iloc[:56, -1] = trained_gam[stations[0]]["prediction"]
-    template.iloc[56:-56, -1] = trained_gam[stations[1]]["prediction"]
-    template.iloc[-56:, -1] = trained_gam[stations[2]]["prediction"]
+    rows = station_rows(template, stations, {station: len(trained_gam[station]["prediction"]) for station in stations}, registry)
+    for station in stations:
+        template.loc[template.index[rows[station]], "value"] = trained_gam[station]["prediction"].to_numpy()
+    # bounds of the prediction interval, if computed for all the stations
+    bounds = [bound for bound in ["lower", "upper"] if all("prediction_%s" % bound in trained_gam[station] for station in stations)]
+    for bound in bounds:
+        template[bound] = np.nan
+        for station in stations:
+            template.loc[template.index[rows[station]], bound] = trained_gam[station]["prediction_%s" % bound].to_numpy()
     if apply_abs:
-        template.value[template.value < 0] = 0
+        template.loc[template.value < 0, "value"] = 0
+        for bound in bounds:
+            template[bound] = template[bound].clip(lower=0)
     if not os.path.isdir(output_path):
         os.makedirs(output_path)
     output_file = "phase-%s_%s.csv" % (phase, datetime.now().strftime("%Y-%m-%d_%H-%M-%S"))
@@ -79,21 +207,24 @@ overall         MAPE mean   MAPE mean   ...     MAPE mean
 
 Best method and parameter can be retrieved by the errors over phase-1 stations.
 """
-def show_errors(trained_gam, combined_load_by_station, phase, data_folder, apply_abs=True):
-    stations = STATIONS[(phase-1)*3:phase*3]
-    smoothing_candidate = [
-        ("daily_max", None), ("hourly_mean", None), ("hourly_max", None), 
-        ("averaged_smoothed_max", 9), ("averaged_smoothed_max", 13), ("averaged_smoothed_max", 17), 
-        ("weighted_smoothed_max", 9), ("weighted_smoothed_max", 13), ("weighted_smoothed_max", 17)
-    ]
-    keys = []
-    for (method, ws) in smoothing_candidate:
-        keys.append(method if ws is None else "%s-%s" % (method, ws))
-        generate_prediction(trained_gam, combined_load_by_station, method=method, ws=ws, save_key=keys[-1])
+SMOOTHING_CANDIDATES = [
+    ("daily_max", None), ("hourly_mean", None), ("hourly_max", None), 
+    ("averaged_smoothed_max", 9), ("averaged_smoothed_max", 13), ("averaged_smoothed_max", 17), 
+    ("weighted_smoothed_max", 9), ("weighted_smoothed_max", 13), ("weighted_smoothed_max", 17)
+]
+
+def show_errors(trained_gam, combined_load_by_station, phase, data_folder, apply_abs=True, smoothing_candidate=SMOOTHING_CANDIDATES, registry=None):
+    # scikit-learn is only needed to evaluate, not to predict
+    from sklearn.metrics import mean_squared_error
+    stations = phase_stations(phase, registry)
+    keys = list(_candidate_keys(smoothing_candidate))
+    # all the candidates of a station are evaluated in one vectorized pass
+    for station, result in trained_gam.items():
+        trained_gam[station].update(evaluate_candidates(combined_load_by_station[station]["Combined Load"].value,
+                                                        result["test_result"], smoothing_candidate))
     solution = pd.read_csv(os.path.join(data_folder, "phase-%s" % phase, "solution_phase%s.csv" % phase))
-    solution = [solution[:56], solution[56:-56], solution[-56:]]
-    for s in solution:
-        s.index = pd.to_datetime(s.date, format="%d/%m/%Y")
+    rows = station_rows(solution, stations, {station: len(trained_gam[station][keys[0]]) for station in stations}, registry)
+    solution = [solution.iloc[rows[station]] for station in stations]
     errors = [[] for _ in range(len(stations))]
     for i, station in enumerate(stations):
         for key in keys:
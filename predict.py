@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Mar 16 14:30:00 2022
+@author: WOJJ
+
+Prediction-only entry point using a model artifact (see `artifact.py`)
+
+    python ./predict.py --model model.npz --data-folder ../data --output ../predictions
+    python ./predict.py --model model.npz --data-folder ../data --output ../submissions --phase 2
+
+Only the stations of the artifact and their nearby stations are loaded, and only the
+pre-processing needed by the test window is run with the parameters of the artifact:
+    - load: outlier removal with the stored bounds and averaged smoothing of the last
+      LAG_STEPS rows (plus the smoothing window)
+    - national demand: weighted smoothing around the test window
+    - weather: exponential smoothing (the initial level depends on the whole series)
+The forecast window is the HORIZON_DAYS following --start (default: the end of the Training
+Data), so a new horizon is scored with newer Training Data without refitting.
+The predictions are post-processed by `generate_prediction` and dumped to a csv file
+(and to a submission file with --phase). pygam and scikit-learn are not imported.
+"""
+
+import os
+import argparse
+import pandas as pd
+from datetime import datetime
+
+from data_loader import load_data, required_stations
+from preprocess import weather_smoothing, weighted_smoothing, load_outlier_removal, load_smoothing, pack_dataset, forecast_index, LAG_STEPS
+from postprocess import generate_prediction, generate_submission
+from artifact import load_artifact, predict_artifact
+
+import warnings
+warnings.filterwarnings("ignore")
+
+# forecast window of the test set, same length as the lag of the load feature
+HORIZON_DAYS = 56
+
+# start: first time of the forecast window (default: the end of the Training Data of the stations)
+def predict(artifact, data_folder, stations=None, method="averaged_smoothed_max", ws=13, cache=True, start=None):
+    preprocessing = artifact["preprocessing"]
+    if preprocessing["lag_steps"] != LAG_STEPS:
+        raise ValueError("The artifact uses %s lag steps, %s expected" % (preprocessing["lag_steps"], LAG_STEPS))
+    stations = list(artifact["stations"]) if stations is None else stations
+    registry = {station: artifact["registry"][station] for station in required_stations(stations, artifact["registry"])}
+
+    data_by_station, combined_load_by_station, national_demand = load_data(data_folder, cache=cache, registry=registry)
+
+    # the load features of the window are the LAG_STEPS rows before start
+    test_index = forecast_index(data_by_station, stations, start=start, horizon_days=HORIZON_DAYS)
+    start = test_index[0]
+    print("Forecast window: %s - %s" % (test_index[0], test_index[-1]))
+
+    weather_smoothing(data_by_station, alphas=preprocessing["alphas"])
+    # national demand around the test window
+    margin = pd.Timedelta(days=1)
+    national_demand = national_demand[(national_demand.index >= test_index[0] - margin) & (national_demand.index <= test_index[-1] + margin)]
+    national_demand = weighted_smoothing(national_demand, ws=preprocessing["national_ws"]).value
+    # load of the last LAG_STEPS rows used by the test window
+    for station, data in data_by_station.items():
+        load = data["Training Data"]
+        data["Training Data"] = load[load.index < start].iloc[-(LAG_STEPS + preprocessing["load_ws"]):]
+    load_outlier_removal(data_by_station, registry=registry, bounds=artifact["outlier_bounds"])
+    if preprocessing["input_smoothed"]:
+        load_smoothing(data_by_station, ws=preprocessing["load_ws"], skipna=preprocessing["skipna"])
+
+    dataset_by_station = pack_dataset(data_by_station, national_demand, stations, input_smoothed=preprocessing["input_smoothed"],
+                                      registry=registry, test_only=True, test_index=test_index)
+    predicted = {}
+    for station in stations:
+        test_df = dataset_by_station[station]["test"]
+        predicted[station] = {"test_result": pd.Series(predict_artifact(artifact["stations"][station], test_df), index=test_df.index)}
+    generate_prediction(predicted, combined_load_by_station, method=method, ws=ws)
+    return predicted
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Predict the test window with a model artifact")
+    parser.add_argument("--model", required=True, help="model artifact saved by run.py (ARTIFACT_FILE)")
+    parser.add_argument("--data-folder", required=True)
+    parser.add_argument("--output", required=True, help="folder of the output csv files")
+    parser.add_argument("--stations", nargs="*", default=None, help="stations to predict (default: all the stations of the artifact)")
+    parser.add_argument("--method", default="averaged_smoothed_max", help="post-process method, see `postprocess.py`")
+    parser.add_argument("--ws", type=int, default=13, help="window size of the post-process method")
+    parser.add_argument("--phase", type=int, default=None, help="also generate the submission file of this phase")
+    parser.add_argument("--no-abs", action="store_true", help="keep the negative values in the submission")
+    parser.add_argument("--no-cache", action="store_true", help="do not cache the parsed csv files")
+    parser.add_argument("--start", default=None, help="start of the 56-day forecast window, e.g. 2021-10-04 (default: end of the Training Data)")
+    args = parser.parse_args()
+
+    artifact = load_artifact(args.model)
+    predicted = predict(artifact, args.data_folder, stations=args.stations, method=args.method, ws=args.ws, cache=not args.no_cache,
+                        start=args.start)
+
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    output_file = os.path.join(args.output, "prediction_%s.csv" % datetime.now().strftime("%Y-%m-%d_%H-%M-%S"))
+    pd.DataFrame({station: result["prediction"] for station, result in predicted.items()}).to_csv(output_file)
+    print("Predictions dumped to:", output_file)
+    if args.phase is not None:
+        generate_submission(predicted, args.phase, args.data_folder, output_path=args.output, apply_abs=not args.no_abs,
+                            registry={station: artifact["registry"][station] for station in predicted})
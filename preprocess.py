@@ -8,91 +8,357 @@ Provide functions of pre-processing data
 
 import numpy as np
 import pandas as pd
-from statsmodels.tsa.holtwinters import SimpleExpSmoothing
+from multiprocessing import shared_memory
+from scipy.signal import lfilter
+
+from data_loader import REGISTRY
 
 # alpha for exponential smoothing
 ALPHAS = {"temperature": 5e-2, "solar_irradiance": 5e-1, "windspeed_north": 5e-1, "windspeed_east": 5e-1}
 
-# Only apply outlier removal to the following stations (based on experiments)
-OUTLIER_REMOVAL = {"BOURNVILLE CB 7", "BRIDPORT CB 306", "PORTISHEAD ASHLANDS CB 4"}
-
-NEARBY_STATIONS = {
-    "BOURNVILLE CB 7": ["BRADLEY STOKE CB 8"], 
-    "BRADLEY STOKE CB 8": ["BOURNVILLE CB 7"], 
-    "STRATTON CB 4041": [],
-    "BRIDPORT CB 306": ["HEMYOCK CB 56_24"], 
-    "HEMYOCK CB 56_24": ["BRIDPORT CB 306"], 
-    "PORTISHEAD ASHLANDS CB 4": ["BOURNVILLE CB 7", "BRADLEY STOKE CB 8"]
-}
-
-def avgeraged_smoothing(c, ws=7):
-    weights = np.ones(ws) / ws
-    conved = pd.DataFrame(data={"value":np.convolve(c.to_numpy(), weights, mode='same')}, index=c.index)
-    return conved
-
-def weighted_smoothing(c, ws=5):
-    weights = np.arange(1, ws+1)
-    weights[int(ws/2):] = weights[:int(ws/2)+1][::-1]
-    weights = weights / weights.sum()
-    return pd.DataFrame(data={"value":np.convolve(c.to_numpy(), weights, mode='same')}, index=c.index)
-
-def exponential_smoothing(v, alpha, cubic=False):
+# Only apply outlier removal to the stations flagged in the registry (based on experiments)
+OUTLIER_REMOVAL = {station for station, entry in REGISTRY.items() if entry["outlier_removal"]}
+
+NEARBY_STATIONS = {station: entry["nearby"] for station, entry in REGISTRY.items()}
+
+def avgeraged_smoothing(c, ws=7, skipna=False):
+    return pd.DataFrame(data={"value": smooth(c.to_numpy(), ws, method="averaged", skipna=skipna)}, index=c.index)
+
+def weighted_smoothing(c, ws=5, skipna=False):
+    return pd.DataFrame(data={"value": smooth(c.to_numpy(), ws, method="weighted", skipna=skipna)}, index=c.index)
+
+"""
+Smoothing engine shared by the averaged and weighted smoothing.
+
+Both kernels are computed with prefix sums in O(n) regardless of the window size:
+    - averaged: box kernel of length ws
+    - weighted: triangular kernel [1, 2, ..., (ws+1)/2, ..., 2, 1] (ws must be odd),
+      i.e. two box kernels of length (ws+1)/2
+The result is identical to np.convolve(v, weights, mode='same') with zero padding.
+If skipna is True, the NaN values (and the padding) are excluded from the window
+and the remaining weights are renormalised, otherwise NaN propagates through the window.
+If causal is True, the window ends at the current sample instead of being centred.
+Passing a list of window sizes returns a 2-D array with one row per window size.
+"""
+def smooth(v, ws, method="averaged", skipna=False, causal=False):
+    v = np.asarray(v, dtype=float)
+    batched = np.ndim(ws) > 0
+    windows = np.atleast_1d(ws).astype(int)
+    if method == "averaged":
+        lengths = [windows]
+    elif method == "weighted":
+        if any(windows % 2 == 0):
+            raise ValueError("weighted smoothing requires odd window sizes, got %s" % windows)
+        lengths = [(windows + 1) // 2, (windows + 1) // 2]
+    else:
+        raise ValueError("Unknown smoothing method `%s`" % method)
+    offsets = np.zeros_like(windows) if causal else (windows - 1) // 2
+    nan_mask = np.isnan(v)
+    sums = _kernel_sums(np.where(nan_mask, 0., v), lengths, offsets)
+    if skipna:
+        counts = _kernel_sums((~nan_mask).astype(float), lengths, offsets)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            result = np.where(counts > 0, sums / counts, np.nan)
+    else:
+        result = sums / np.prod(lengths, axis=0)[:, None]
+        if nan_mask.any():
+            result[_kernel_sums(nan_mask.astype(float), lengths, offsets) > 0] = np.nan
+    return result if batched else result[0]
+
+# windowed sums of v for a kernel made of consecutive box kernels, one row per window size
+# lengths: list of box lengths (one array per box), offsets: shift of the window end
+def _kernel_sums(v, lengths, offsets):
+    sums = v[None, :]
+    # full convolution with all but the last box
+    for length in lengths[:-1]:
+        sums = _window_sums(sums, length, np.zeros_like(length), sums.shape[1] + length.max() - 1)
+    return _window_sums(sums, lengths[-1], offsets, len(v))
+
+# out[k, i] = sum(v[k, i + offsets[k] - lengths[k] + 1 : i + offsets[k] + 1]) with zero padding
+# a single row of v is shared by all the windows (one cumulative sum)
+def _window_sums(v, lengths, offsets, size):
+    n = v.shape[1]
+    pad = max(lengths.max(), size - n + offsets.max())
+    csum = np.zeros((v.shape[0], n + 2*pad + 1))
+    csum[:, pad+1:pad+n+1] = np.cumsum(v, axis=1)
+    csum[:, pad+n+1:] = csum[:, pad+n:pad+n+1]
+    idx = np.arange(size)
+    out = np.empty((len(lengths), size))
+    for k, (length, offset) in enumerate(zip(lengths, offsets)):
+        hi = pad + idx + offset + 1
+        row = csum[k if v.shape[0] > 1 else 0]
+        out[k] = row[hi] - row[hi - length]
+    return out
+
+"""
+Simple exponential smoothing with a fixed alpha, equivalent to the fittedvalues of
+statsmodels' SimpleExpSmoothing(v).fit(smoothing_level=alpha):
+
+    fitted[0] = l0, fitted[t] = alpha*v[t-1] + (1-alpha)*fitted[t-1]
+
+The recursion is run by scipy.signal.lfilter over all the columns of a 2-D array.
+With alpha fixed, the fitted values are linear in the initial level l0, so the l0
+minimising the sum of squared errors (estimated by statsmodels' optimizer) has a closed form.
+"""
+def exponential_smoothing(v, alpha, cubic=False, initial_level=None):
     v_ = v if not cubic else (v + v**2 + v**3)
-    return SimpleExpSmoothing(v_).fit(smoothing_level=alpha).fittedvalues
+    fitted = exponential_smoothing_array(v_.to_numpy()[:, None], alpha, initial_level=initial_level)[:, 0]
+    return pd.Series(fitted, index=v.index)
 
-def weather_smoothing(data_by_station, weather_cols=ALPHAS.keys()):
+def exponential_smoothing_array(values, alpha, initial_level=None):
+    values = np.asarray(values, dtype=float)
+    fitted = np.zeros_like(values)
+    fitted[1:] = lfilter([alpha], [1, alpha-1], values[:-1], axis=0)
+    decay = (1 - alpha) ** np.arange(len(values))
+    if initial_level is None:
+        initial_level = decay @ (values - fitted) / (decay @ decay)
+    return fitted + np.outer(decay, initial_level)
+
+def weather_smoothing(data_by_station, weather_cols=ALPHAS.keys(), alphas=ALPHAS):
+    # stations sharing the same weather DataFrame are smoothed once
+    smoothed_by_id = {}
     for station, data in data_by_station.items():
-        data_by_station[station]["Weather Data"] = { col:
-            exponential_smoothing(data["Weather Data"][col], ALPHAS[col], cubic=(col == "temperature"))
-            for col in weather_cols
-        }
+        weather = data["Weather Data"]
+        if id(weather) not in smoothed_by_id:
+            smoothed_by_id[id(weather)] = smooth_weather(weather, weather_cols, alphas=alphas)
+        data_by_station[station]["Weather Data"] = smoothed_by_id[id(weather)]
+
+# exponential smoothing of the weather columns, the columns sharing the same alpha are filtered together
+def smooth_weather(weather, weather_cols=ALPHAS.keys(), alphas=ALPHAS):
+    columns = {col: weather[col].to_numpy(dtype=float) for col in weather_cols}
+    # cubic transformation of temperature
+    if "temperature" in columns:
+        t = columns["temperature"]
+        columns["temperature"] = t + t**2 + t**3
+    smoothed = {}
+    for alpha in set(alphas[col] for col in columns):
+        cols = [col for col in columns if alphas[col] == alpha]
+        fitted = exponential_smoothing_array(np.column_stack([columns[col] for col in cols]), alpha)
+        for i, col in enumerate(cols):
+            smoothed[col] = pd.Series(fitted[:, i], index=weather.index)
+    return {col: smoothed[col] for col in columns}
 
-def load_outlier_removal(data_by_station, n_times_std=3):
+# returns the bounds of the stations with outlier removal, or applies the given bounds
+def load_outlier_removal(data_by_station, n_times_std=3, registry=None, bounds=None):
+    registry = REGISTRY if registry is None else registry
+    outlier_bounds = {}
     for station, data in data_by_station.items():
         training_value = data["Training Data"].value
-        if station in OUTLIER_REMOVAL:
+        if bounds is not None and station in bounds:
+            outlier_bounds[station] = bounds[station]
+        elif bounds is None and station in registry and registry[station]["outlier_removal"]:
+            n_std = registry[station].get("n_times_std", n_times_std)
             mean, std = np.mean(training_value), np.std(training_value)
-            training_value[training_value > mean + n_times_std*std] = np.nan
-            training_value[training_value < mean - n_times_std*std] = np.nan
+            outlier_bounds[station] = (mean - n_std*std, mean + n_std*std)
+        if station in outlier_bounds:
+            low, high = outlier_bounds[station]
+            training_value[training_value > high] = np.nan
+            training_value[training_value < low] = np.nan
         data_by_station[station]["Training Data"] = training_value
+    return outlier_bounds
 
-def load_smoothing(data_by_station, ws=7):
+def load_smoothing(data_by_station, ws=7, skipna=False):
     for station, data in data_by_station.items():
-        data["Training Data"] =  avgeraged_smoothing(data["Training Data"], ws=ws).value
+        data["Training Data"] =  avgeraged_smoothing(data["Training Data"], ws=ws, skipna=skipna).value
+
+# number of 15-minute steps in 56 days: the load of 56 days ago is used as a feature
+LAG_STEPS = 5376
+# forecast window of the test set
+TEST_INDEX = pd.date_range('2021-10-04', '2021-11-29', freq='15T', closed='left')
+CALENDAR_COLUMNS = ['month', 'hour', 'day', 'doW_x', 'doW_y']
+
+# forecast window of horizon_days from start (default: the step after the end of the Training Data of the stations)
+# the Training Data of each station before start must end at the step before start, with at least LAG_STEPS rows
+def forecast_index(data_by_station, stations, start=None, horizon_days=56):
+    step = pd.Timedelta(minutes=15)
+    if start is None:
+        start = max(data_by_station[station]["Training Data"].index[-1] for station in stations) + step
+    start = pd.Timestamp(start)
+    for station in stations:
+        load = data_by_station[station]["Training Data"]
+        load = load[load.index < start]
+        if len(load) < LAG_STEPS or load.index[-1] != start - step:
+            raise ValueError("The Training Data of %s must end at %s (the step before the start of the window)" % (station, start - step))
+    return pd.date_range(start, start + pd.Timedelta(days=horizon_days), freq='15T', closed='left')
 
 # Concatenate all the features here to create the dataset
-def pack_dataset(data_by_station, national_demand, stations, input_smoothed=False):
+# Each frame is built from one contiguous feature matrix of the given dtype (float32 halves the memory)
+# With test_only, only the test frames are packed (the train frames are None)
+# test_index is the forecast window following the last LAG_STEPS rows of the Training Data
+# The calendar, national demand and weather features are taken from a FeatureStore, built for the call if not given
+def pack_dataset(data_by_station, national_demand, stations, input_smoothed=False, dtype=np.float64, registry=None, test_only=False,
+                 test_index=TEST_INDEX, store=None):
+    registry = REGISTRY if registry is None else registry
+    nearby_stations = {station: entry["nearby"] for station, entry in registry.items()}
     dataset_by_station = {station: {"train": None, "test": None} for station in stations}
+    if store is None:
+        store = FeatureStore.from_stations(data_by_station, national_demand, [s for s in stations if s in data_by_station], registry, test_index)
     for station in stations:
         if station not in data_by_station:
             print("Invalid station name:", stations)
             continue
         data = data_by_station[station]
-        v = data["Training Data"]
+        v = data["Training Data"].to_numpy()
+        # load of the nearby stations 56 days before each row, aligned by time (their histories may differ from the station's)
+        nearby = [data_by_station[nearby_station]["Training Data"] for nearby_station in nearby_stations[station]]
+        lag = LAG_STEPS * pd.Timedelta(minutes=15)
         # train & test
-        dfs = [pd.DataFrame(np.transpose([v.values[:-5376], v.values[5376:]]), index=v.index[5376:], columns=['prev_2_mo', 'target']),
-               pd.DataFrame(np.transpose([v.values[-5376:]]), index=pd.date_range('2021-10-04', '2021-11-29', freq='15T', closed='left'), columns = ['prev_2_mo'])]
-        for i, df in enumerate(dfs):
-            # national demand
-            df['national'] = national_demand
-            # calendar features
-            df['month'] = df.index.month
-            df['hour'] = df.index.hour
-            df['day'] =  df.index.dayofyear
-            # temporal encoding of day of week
-            df['doW_x'] =  np.sin(df.index.weekday / 7 * 2 * np.pi)
-            df['doW_y'] =  np.cos(df.index.weekday / 7 * 2 * np.pi)
-            # weather features
-            for wf in ALPHAS.keys():
-                df[wf] = data["Weather Data"][wf]
-            # load of nearby station(s)
-            for nearby_station in NEARBY_STATIONS[station]:
-                if i == 0: # train
-                    df[nearby_station] = data_by_station[nearby_station]["Training Data"].values[:-5376]
-                else: # test
-                    df[nearby_station] = data_by_station[nearby_station]["Training Data"].values[-5376:]
-            # Drop nan value (including outliers) -> hourly data
-            df.dropna(inplace=True)
-        dataset_by_station[station]["train"] = dfs[0] if not input_smoothed else dfs[0].iloc[1:]
-        dataset_by_station[station]["test"] = dfs[1]
-    return dataset_by_station
\ No newline at end of file
+        if not test_only:
+            train = pack_frame(data_by_station[station]["Training Data"].index[LAG_STEPS:], v[:-LAG_STEPS], national_demand, data["Weather Data"],
+                               [align(n, data["Training Data"].index[LAG_STEPS:] - lag) for n in nearby], nearby_stations[station], target=v[LAG_STEPS:], dtype=dtype,
+                               store=store, weather_id=registry[station]["weather"])
+            dataset_by_station[station]["train"] = train if not input_smoothed else train.iloc[1:]
+        test = pack_frame(test_index, v[-LAG_STEPS:], national_demand, data["Weather Data"],
+                          [align(n, test_index - lag) for n in nearby], nearby_stations[station], dtype=dtype,
+                          store=store, weather_id=registry[station]["weather"])
+        dataset_by_station[station]["test"] = test
+    return dataset_by_station
+
+# features of one frame in the column order:
+#   prev_2_mo, (target), national, month, hour, day, doW_x, doW_y, weather features, nearby station(s)
+# national demand, calendar and weather features are read from store (rows of the index on its timeline) if possible
+def pack_frame(index, prev, national_demand, weather, nearby, nearby_names, target=None, dtype=np.float64, store=None, weather_id=None):
+    columns = ['prev_2_mo'] + (['target'] if target is not None else []) + ['national'] + CALENDAR_COLUMNS + list(ALPHAS.keys()) + list(nearby_names)
+    matrix = np.empty((len(index), len(columns)), dtype=dtype)
+    matrix[:, 0] = prev
+    col = 1
+    if target is not None:
+        matrix[:, col] = target
+        col += 1
+    positions = None if store is None or not store.has_weather(weather_id) else store.positions(index)
+    if positions is not None:
+        matrix[:, col] = store.arrays["national"][positions]
+        matrix[:, col+1:col+6] = store.arrays["calendar"][positions]
+        matrix[:, col+6:col+6+len(ALPHAS)] = store.arrays["weather_%s" % weather_id][positions]
+        col += 6 + len(ALPHAS)
+    else:
+        # national demand
+        matrix[:, col] = align(national_demand, index)
+        # calendar features
+        matrix[:, col+1:col+6] = calendar_features(index)
+        col += 6
+        # weather features, the smoothed columns share the same index
+        weather_indexer = None
+        for wf in ALPHAS.keys():
+            if weather_indexer is None or not weather[wf].index.equals(weather_index):
+                weather_index, weather_indexer = weather[wf].index, weather[wf].index.get_indexer(index)
+            matrix[:, col] = align(weather[wf], index, indexer=weather_indexer)
+            col += 1
+    # load of nearby station(s)
+    for values in nearby:
+        matrix[:, col] = values
+        col += 1
+    # Drop nan value (including outliers) -> hourly data
+    valid = ~np.isnan(matrix).any(axis=1)
+    return pd.DataFrame(matrix[valid], index=index[valid], columns=columns)
+
+def calendar_features(index):
+    weekday = index.weekday / 7 * 2 * np.pi
+    # month, hour, day of year and temporal encoding of day of week
+    return np.column_stack([index.month, index.hour, index.dayofyear, np.sin(weekday), np.cos(weekday)])
+
+# values of series at index (NaN where missing), same as the alignment of a DataFrame column assignment
+def align(series, index, indexer=None):
+    indexer = series.index.get_indexer(index) if indexer is None else indexer
+    values = series.to_numpy(dtype=float)[indexer]
+    values[indexer < 0] = np.nan
+    return values
+
+"""
+Feature store shared by the stations
+
+The national demand, calendar and weather features only depend on the time (and the weather
+id of the station), but pack_frame would extract the calendar fields and align the national
+demand and the weather on the index of every frame of every station. FeatureStore computes
+them once on a regular 15-minute timeline covering the frames:
+
+    arrays["calendar"]: (n, 5) calendar_features of the timeline
+    arrays["national"]: (n,) national demand aligned on the timeline
+    arrays["weather_{id}"]: (n, len(ALPHAS)) weather features of each weather id
+
+and a frame takes the rows of its index by position (integer offset from the start of the
+timeline), so the cost per station is a copy of its rows. The arrays are read-only. The
+values are the same as computing them on the index of each frame. An index not on the
+timeline (not a multiple of 15 minutes from its start, or out of it) falls back to the
+computation on the index. The loads of 56 days ago are slices (views) of the load arrays,
+so they are not stored.
+
+With `share`, the arrays are moved to shared memory: pickling the store (e.g. to send it to
+worker processes) then only sends the names of the blocks, which the workers attach to
+without copying. The process that shared the store releases the blocks with `close`.
+"""
+class FeatureStore:
+    step = pd.Timedelta(minutes=15)
+
+    def __init__(self, start, end, national_demand, weather_by_id):
+        self.start = pd.Timestamp(start)
+        timeline = pd.date_range(self.start, pd.Timestamp(end), freq=self.step)
+        self.arrays = {"calendar": calendar_features(timeline).astype(np.float64),
+                       "national": align(national_demand, timeline)}
+        for weather_id, weather in weather_by_id.items():
+            self.arrays["weather_%s" % weather_id] = np.column_stack([align(weather[wf], timeline) for wf in ALPHAS.keys()])
+        for array in self.arrays.values():
+            array.flags.writeable = False
+        self._shm = {}
+        self._owner = False
+
+    # timeline covering the Training Data of the stations and the test window
+    @staticmethod
+    def from_stations(data_by_station, national_demand, stations, registry=None, test_index=TEST_INDEX):
+        registry = REGISTRY if registry is None else registry
+        indexes = [data_by_station[station]["Training Data"].index for station in stations] + [test_index]
+        indexes = [index for index in indexes if len(index) > 0]
+        weather_by_id = {registry[station]["weather"]: data_by_station[station]["Weather Data"] for station in stations}
+        return FeatureStore(min(index[0] for index in indexes), max(index[-1] for index in indexes), national_demand, weather_by_id)
+
+    def has_weather(self, weather_id):
+        return "weather_%s" % weather_id in self.arrays
+
+    # rows of the index on the timeline, None if the index is not on the timeline
+    def positions(self, index):
+        if not isinstance(index, pd.DatetimeIndex) or index.tz is not None:
+            return None
+        offset = index.asi8 - self.start.value
+        if len(offset) == 0 or (offset % self.step.value).any():
+            return None
+        positions = offset // self.step.value
+        if positions.min() < 0 or positions.max() >= len(self.arrays["national"]):
+            return None
+        return positions
+
+    # move the arrays to shared memory
+    def share(self):
+        for name, array in self.arrays.items():
+            shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+            shared[:] = array
+            shared.flags.writeable = False
+            self.arrays[name], self._shm[name] = shared, shm
+        self._owner = True
+        return self
+
+    def close(self):
+        self.arrays = {}
+        for shm in self._shm.values():
+            shm.close()
+            if self._owner:
+                shm.unlink()
+        self._shm = {}
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        if len(self._shm) > 0:
+            state["arrays"] = {name: (self._shm[name].name, array.shape, array.dtype.str) for name, array in self.arrays.items()}
+            state["_shm"], state["_owner"] = None, False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._shm is None:
+            # attach to the shared memory blocks of the arrays
+            self._shm, arrays = {}, self.arrays
+            self.arrays = {}
+            for name, (shm_name, shape, dtype) in arrays.items():
+                self._shm[name] = shared_memory.SharedMemory(name=shm_name)
+                self.arrays[name] = np.ndarray(shape, dtype=dtype, buffer=self._shm[name].buf)
+                self.arrays[name].flags.writeable = False
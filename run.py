@@ -21,11 +21,18 @@ Workflow:
 """
 
 import os
+import sys
+from datetime import datetime
 
-from data_loader import load_data, STATIONS
+from data_loader import load_data, load_registry, phase_stations, REGISTRY_FILE, CACHE_FOLDER
 from preprocess import *
-from gam import train_gam
+from gam import train_gam, update_gam, save_trained_gam, load_trained_gam
 from postprocess import generate_prediction, generate_submission, show_errors
+from instrument import RECORDER, stage
+from sweep import sweep
+from backtest import backtest
+from artifact import save_artifact
+from neighbours import correlation_index, select_nearby, with_nearby, nearby_tradeoff
 
 import warnings
 warnings.filterwarnings("ignore")
@@ -33,22 +40,37 @@ warnings.filterwarnings("ignore")
 # Configurations
 # Please refer to `data_loader.py` to ensure the structure inside the data folder.
 DATA_FOLDER = os.path.join("..", "data")
+# Cache the parsed csv files in `DATA_FOLDER/cache` (parquet, requires pyarrow)
+CACHE_DATA = True
+# Only load the Training Data within [LOAD_START, LOAD_END) and the weather/national demand around it (None: no bound)
+# the GAM forecasts the 56 days after the loaded Training Data: with LOAD_END before its end, the models are trained
+# (and saved) but the prediction is not post-processed nor submitted
+LOAD_START = None # e.g. "2021-01-01"
+LOAD_END = None
 
-# Specified the PHASE. Different phases contain different stations
+# Registry of the stations (phase, weather id, nearby stations, outlier removal), see `data_loader.py`
+STATION_REGISTRY = REGISTRY_FILE # default: stations.json
+
+# Specified the PHASE. Different phases contain different stations (see STATION_REGISTRY)
 PHASE = 1 # or 2
-# If PHASE is not set to 1 and 2, then you can specify the stations you want to run.
+# If PHASE is not a phase of the registry, then you can specify the stations you want to run.
 INPUT_STATIONS = ["BRADLEY STOKE CB 8", "HEMYOCK CB 56_24"] # examples
 
-# Generate submission only works when PHASE is 1 or 2.
+# Generate submission only works when PHASE is a phase of the registry.
 SUBMISSION_FLAG = True
 # A folder for the output submission file if SUBMISSION_FLAG is True
 SUBMISSION_PATH = os.path.join("..", "submissions")
+# Record wall time, CPU time and memory of each stage (and station) in a json file next to the submission
+# (the peak memory is the peak of the process so far, see `instrument.py`)
+PROFILE = False
 
 # Show errors on phase-1
 SHOW_ERROR = True
 
 # Smooth the input load. (True is recommended)
 SMOOTH_INPUT = True
+# Ignore the NaN values (e.g. removed outliers) inside the smoothing window instead of propagating them
+SMOOTH_SKIPNA = False
 # Remove negative values in the prediction of EV chargers. (True is recommended)
 APPLY_ABS = True
 # Method for combined load smoothing
@@ -69,50 +91,175 @@ WS = 13
 N_SPLINES = 10
 # Strength of smoothing penalty. Must be a positive float. Larger values enforce stronger smoothing.
 LAMBDA = 0.1
+# Number of worker processes used to fit the stations in parallel (1: serial, None: all cores)
+N_JOBS = 1
+# Memory budget (MB) of the model matrix when predicting, the rows are predicted in blocks (None: all rows at once)
+# the predictions of the blocks are concatenated, only the model matrix is bounded
+PREDICT_MEMORY_MB = None
+# Number of threads predicting the row blocks
+PREDICT_THREADS = 1
+# GAM backend: "pygam" or "sparse" (sparse B-spline bases and a penalized least squares solver, see `sparse_gam.py`)
+GAM_BACKEND = "pygam"
+# Prediction interval of the daily EV peak from sample paths of the prediction: "bootstrap", "covariance" (pygam only) or None
+# The lower and upper bounds (UNCERTAINTY_QUANTILES of N_SAMPLES post-processed samples) are added to the submission
+UNCERTAINTY = None
+N_SAMPLES = 200
+UNCERTAINTY_QUANTILES = (0.05, 0.95)
+
+# Hyperparameter sweep
+# Evaluate the candidates of N_SPLINES and LAMBDA on the last 56 days of the training data instead of training
+SWEEP = False
+SWEEP_N_SPLINES = [4, 10]
+SWEEP_LAMBDAS = [0.01, 0.1, 1, 10]
+# Number of random candidates (None: grid search over SWEEP_N_SPLINES x SWEEP_LAMBDAS)
+SWEEP_N_ITER = None
+
+# Rolling-origin backtest
+# Train and forecast BACKTEST_FOLDS windows of 56 days in the history, every BACKTEST_STEP_DAYS days, instead of training
+BACKTEST = False
+BACKTEST_FOLDS = 4
+BACKTEST_STEP_DAYS = 56
+
+# Nearby stations
+# Select the nearby stations of each station by the correlation of their loads instead of the registry
+AUTO_NEARBY = False
+# Maximum number of nearby stations of each station
+NEARBY_K = 2
+# Maximum number of tensor terms added by the nearby stations over all the stations (None: no limit)
+NEARBY_TERM_BUDGET = None
+# Report the fit time and the MAPE on the last 56 days for 0..NEARBY_K nearby stations instead of training
+NEARBY_REPORT = False
+
+# Incremental training
+# File of the trained models (None: the models are not saved)
+# the normal equations are kept with each model: the sparse upper triangle of X'X is about 40 MB per station
+# at N_SPLINES = 10 (6001 coefficients, 275 MB dense), about 1 MB at N_SPLINES = 4
+MODEL_FILE = None # e.g. os.path.join(SUBMISSION_PATH, "trained_gam_phase-%s.pkl" % PHASE)
+# Update the models in MODEL_FILE with the new rows of the training data instead of refitting them
+UPDATE_MODEL = False
+# Lightweight model artifact (coefficients, terms and pre-processing parameters) used by `predict.py` (None: not saved)
+ARTIFACT_FILE = None # e.g. os.path.join(SUBMISSION_PATH, "model_phase-%s.npz" % PHASE)
 
 if __name__ == "__main__":
 
-    if PHASE == 1 or PHASE == 2:
+    registry = load_registry(STATION_REGISTRY)
+    IS_PHASE = len(phase_stations(PHASE, registry)) > 0
+
+    if IS_PHASE:
         print("PHASE %s" % PHASE)
     else:
         print("Stations to run: %s" % " ".join(INPUT_STATIONS))
     
+    RECORDER.enabled = PROFILE
+
+    if IS_PHASE:
+        stations2run = phase_stations(PHASE, registry)
+    else:
+        stations2run = INPUT_STATIONS if INPUT_STATIONS is not None else []
+
     # Step 1: Load original data
-    data_by_station, combined_load_by_station, national_demand = load_data(DATA_FOLDER)
+    # only the stations to run and their nearby stations (all the stations to select the nearby stations)
+    with stage("load_data"):
+        data_by_station, combined_load_by_station, national_demand = load_data(
+            DATA_FOLDER, cache=CACHE_DATA, registry=registry, stations=None if AUTO_NEARBY or NEARBY_REPORT else stations2run,
+            start=LOAD_START, end=LOAD_END, weather_columns=list(ALPHAS))
+
+    # Backtest the GAM and the post-processing methods on the history and stop (pre-processed once for all the folds)
+    if BACKTEST:
+        with stage("backtest"):
+            report = backtest(data_by_station, national_demand, stations2run, registry=registry, n_folds=BACKTEST_FOLDS,
+                              step_days=BACKTEST_STEP_DAYS, gam_params={"lam": LAMBDA}, te_params={"n_splines": N_SPLINES},
+                              backend=GAM_BACKEND, input_smoothed=SMOOTH_INPUT, skipna=SMOOTH_SKIPNA, n_jobs=N_JOBS)
+        # report.to_csv(os.path.join(SUBMISSION_PATH, "backtest.csv"))
+        sys.exit()
+
+    # forecast window: the 56 days after the end of the loaded Training Data (TEST_INDEX without LOAD_END)
+    test_index = forecast_index(data_by_station, stations2run)
+    print("Forecast window: %s - %s" % (test_index[0], test_index[-1]))
 
     # Step 2: Pre-process data
     # apply exponential smoothing to selected columns of weather data
-    weather_smoothing(data_by_station)
+    with stage("weather_smoothing"):
+        weather_smoothing(data_by_station)
 
     # apply weighted smoothing to national demands
-    national_demand = weighted_smoothing(national_demand).value
+    with stage("national_demand_smoothing"):
+        national_demand = weighted_smoothing(national_demand).value
 
     # apply outlier removal to loads of selected stations
-    load_outlier_removal(data_by_station)
+    # the models of MODEL_FILE are updated with the outlier bounds of their initial fit (the rows they have seen are unchanged)
+    previous_gam = load_trained_gam(MODEL_FILE) if UPDATE_MODEL and MODEL_FILE is not None and os.path.isfile(MODEL_FILE) else None
+    with stage("load_outlier_removal"):
+        outlier_bounds = load_outlier_removal(data_by_station, registry=registry,
+                                              bounds=None if previous_gam is None else previous_gam["outlier_bounds"])
 
     # apply averaged smoothing to loads
     if SMOOTH_INPUT:
-        load_smoothing(data_by_station)
+        with stage("load_smoothing"):
+            load_smoothing(data_by_station, skipna=SMOOTH_SKIPNA)
 
     # Step 3: Prepare dataset
-    if PHASE == 1 or PHASE == 2:
-        stations2run = STATIONS[(PHASE-1)*3:PHASE*3]
-    else:
-        stations2run = INPUT_STATIONS if INPUT_STATIONS is not None else []
 
-    dataset_by_station = pack_dataset(data_by_station, national_demand, stations2run, input_smoothed=SMOOTH_INPUT)
+    # select the nearby stations by the correlation of the loads (cached with the data)
+    if AUTO_NEARBY or NEARBY_REPORT:
+        with stage("correlation_index"):
+            index = correlation_index(data_by_station, cache_folder=os.path.join(DATA_FOLDER, CACHE_FOLDER) if CACHE_DATA else None)
+        if NEARBY_REPORT:
+            with stage("nearby_report"):
+                report = nearby_tradeoff(data_by_station, national_demand, stations2run, index, ks=range(NEARBY_K+1), registry=registry,
+                                         gam_params={"lam": LAMBDA}, te_params={"n_splines": N_SPLINES}, input_smoothed=SMOOTH_INPUT, n_jobs=N_JOBS)
+            # report.to_csv(os.path.join(SUBMISSION_PATH, "nearby.csv"))
+            sys.exit()
+        nearby = select_nearby(index, stations2run, k=NEARBY_K, term_budget=NEARBY_TERM_BUDGET)
+        registry = with_nearby(nearby, registry)
+        for station in stations2run:
+            print(station, " nearby stations: ", nearby[station])
+
+    with stage("pack_dataset"):
+        dataset_by_station = pack_dataset(data_by_station, national_demand, stations2run, input_smoothed=SMOOTH_INPUT, registry=registry,
+                                          test_index=test_index)
+
+    # Sweep the GAM parameters on the packed dataset and stop
+    if SWEEP:
+        with stage("sweep"):
+            errors = sweep(dataset_by_station, lams=SWEEP_LAMBDAS, n_splines=SWEEP_N_SPLINES, n_iter=SWEEP_N_ITER, n_jobs=N_JOBS,
+                           backend=GAM_BACKEND)
+        # errors.to_csv(os.path.join(SUBMISSION_PATH, "sweep.csv"))
+        sys.exit()
 
     # Step 4: Traing GAM
-    trained_gam = train_gam(dataset_by_station, return_fitted=False, return_test=True, gam_params={"lam": LAMBDA}, te_params={"n_splines": N_SPLINES})
+    # the fit and predictions of each station are recorded by train_gam/update_gam
+    with stage("train_gam"):
+        if previous_gam is not None:
+            trained_gam = update_gam(previous_gam["models"], dataset_by_station, return_test=True)
+        else:
+            trained_gam = train_gam(dataset_by_station, return_fitted=False, return_test=True, gam_params={"lam": LAMBDA}, te_params={"n_splines": N_SPLINES},
+                                    n_jobs=N_JOBS, incremental=MODEL_FILE is not None, predict_memory_mb=PREDICT_MEMORY_MB, predict_threads=PREDICT_THREADS,
+                                    backend=GAM_BACKEND, uncertainty=UNCERTAINTY, n_samples=N_SAMPLES)
+    if MODEL_FILE is not None:
+        save_trained_gam({"models": trained_gam, "outlier_bounds": outlier_bounds}, MODEL_FILE)
+    if ARTIFACT_FILE is not None:
+        save_artifact(trained_gam, ARTIFACT_FILE, registry=registry, outlier_bounds=outlier_bounds,
+                      preprocessing={"input_smoothed": SMOOTH_INPUT, "skipna": SMOOTH_SKIPNA})
+
+    # the combined load, the templates and the solutions of the phases are on TEST_INDEX
+    if not test_index.equals(TEST_INDEX):
+        print("The forecast window is not the test window of the phases (LOAD_END): no post-processing nor submission")
+        sys.exit()
 
     # Step 5: Post-process the prediction
-    generate_prediction(trained_gam, combined_load_by_station, method=COMB_SMOOTH_METHOD, ws=WS)
+    with stage("generate_prediction"):
+        generate_prediction(trained_gam, combined_load_by_station, method=COMB_SMOOTH_METHOD, ws=WS, quantiles=UNCERTAINTY_QUANTILES)
 
     # show errors of phase-1 using different smoothing methods
     if SHOW_ERROR and PHASE == 1:
-        errors = show_errors(trained_gam, combined_load_by_station, PHASE, DATA_FOLDER, apply_abs=APPLY_ABS)
+        with stage("show_errors"):
+            errors = show_errors(trained_gam, combined_load_by_station, PHASE, DATA_FOLDER, apply_abs=APPLY_ABS, registry=registry)
         # errors.to_csv(os.path.join(SUBMISSION_PATH, "errors.csv"))
 
     # generate submission file
-    if SUBMISSION_FLAG and (PHASE == 1 or PHASE == 2):
-        generate_submission(trained_gam, PHASE, DATA_FOLDER, output_path=SUBMISSION_PATH, apply_abs=APPLY_ABS)
+    if SUBMISSION_FLAG and IS_PHASE:
+        generate_submission(trained_gam, PHASE, DATA_FOLDER, output_path=SUBMISSION_PATH, apply_abs=APPLY_ABS, registry=registry)
+
+    if PROFILE:
+        RECORDER.dump(os.path.join(SUBMISSION_PATH, "profile_phase-%s_%s.json" % (PHASE, datetime.now().strftime("%Y-%m-%d_%H-%M-%S"))))
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Mar 18 08:50:00 2022
+@author: WOJJ
+
+Provide a sparse backend of the GAM (tensor product B-spline terms, identity link, normal distribution)
+"""
+
+"""
+pygam builds each tensor term densely (n_rows x prod(n_splines) values, i.e. 1000 columns per
+3-way term with n_splines=10) and fits by P-IRLS on the dense model matrix. For the identity
+link and normal distribution the fit is the penalized least squares solution
+
+    (X'X + P + sqrt(EPS) I) b = X'y
+
+A cubic B-spline row has at most 4 non-zero values (spline_order + 1, inside and outside the
+edge knots), so a row of a 3-way tensor term has at most 64 non-zero values out of 1000.
+SparseGAM builds the model matrix X as a CSR matrix from the non-zero window of each marginal
+basis, accumulates X'X sparsely and solves the system with:
+    - "cholesky": sparse Cholesky (CHOLMOD, if scikit-sparse is installed), otherwise a
+      dense Cholesky of the (small) normal matrix
+    - "cg": conjugate gradient preconditioned by the diagonal, warm started from the last fit
+The basis, the edge knots and the penalty (second order differences of each marginal, as
+pygam's default `derivative` penalty) are the same as pygam's, so the predictions match
+pygam's within the tolerance of the solver (see `validate_backend`).
+
+SparseGAM provides the part of pygam's GAM interface used by this repository:
+fit, predict, set_params, coef_, terms, _modelmat and _P.
+"""
+
+import time
+import numpy as np
+import scipy.sparse as sp
+from scipy.linalg import cho_factor, cho_solve
+from scipy.sparse.linalg import cg, LinearOperator
+
+from artifact import b_spline_basis
+
+try:
+    from sksparse.cholmod import cholesky as sparse_cholesky
+except ImportError: # scikit-sparse is optional
+    sparse_cholesky = None
+
+# same as pygam.pygam.EPS
+EPS = np.finfo(np.float64).eps
+
+class SparseGAM:
+    def __init__(self, terms, n_splines=10, spline_order=3, lam=0.6, solver="cholesky", tol=1e-10, max_iter=None):
+        # terms: features (column positions) of each tensor term, the intercept is added last
+        self.terms = [{"type": "tensor", "features": list(features)} for features in terms] + [{"type": "intercept"}]
+        self.n_splines = n_splines
+        self.spline_order = spline_order
+        self.lam = lam
+        self.solver = solver
+        self.tol = tol
+        self.max_iter = max_iter
+        self.edge_knots_ = None
+        self.coef_ = None
+
+    def set_params(self, **params):
+        for key, value in params.items():
+            if not hasattr(self, key):
+                raise ValueError("Invalid parameter `%s` for SparseGAM" % key)
+            setattr(self, key, value)
+        return self
+
+    def fit(self, X, y):
+        X = _to_array(X)
+        y = np.asarray(y, dtype=np.float64)
+        self._validate_data_dep_params(X)
+        modelmat = self._modelmat(X)
+        XtX = (modelmat.T @ modelmat).tocsc()
+        Xty = modelmat.T @ y
+        self.coef_ = self._solve(XtX + self._P() + np.sqrt(EPS) * sp.identity(XtX.shape[0], format="csc"), Xty)
+        return self
+
+    # edge knots of each feature: min and max of the training data (as pygam, same name)
+    def _validate_data_dep_params(self, X):
+        X = _to_array(X)
+        features = sorted(set(f for term in self.terms[:-1] for f in term["features"]))
+        self.edge_knots_ = {f: np.array([X[:, f].min(), X[:, f].max()]) for f in features}
+
+    def predict(self, X):
+        return self._modelmat(_to_array(X)) @ self.coef_
+
+    # model matrix in CSR format, the columns of the terms are in the order of pygam's
+    def _modelmat(self, X):
+        X = _to_array(X)
+        n = len(X)
+        data, indices, offset = [], [], 0
+        for term in self.terms[:-1]:
+            values, columns, n_coefs = self._tensor_basis(X, term["features"])
+            data.append(values)
+            indices.append(columns + offset)
+            offset += n_coefs
+        # intercept
+        data.append(np.ones((n, 1)))
+        indices.append(np.full((n, 1), offset))
+        data, indices = np.hstack(data), np.hstack(indices)
+        return sp.csr_matrix((data.ravel(), indices.ravel(), np.arange(0, data.size + 1, data.shape[1])), shape=(n, offset + 1))
+
+    # block diagonal penalty: sum over the marginals of lam * D'D (kronecker with the identity of the other marginals)
+    def _P(self):
+        blocks = []
+        for term in self.terms[:-1]:
+            sizes = self._term_n_splines(term)
+            P = sp.csc_matrix((int(np.prod(sizes)), int(np.prod(sizes))))
+            for i in range(len(sizes)):
+                marginal = sp.identity(1, format="csc")
+                for j, size in enumerate(sizes):
+                    marginal = sp.kron(marginal, self.lam * _derivative_penalty(size) if j == i else sp.identity(size), format="csc")
+                P = P + marginal
+            blocks.append(P)
+        blocks.append(sp.csc_matrix((1, 1)))
+        return sp.block_diag(blocks, format="csc")
+
+    # specs of the terms in the format of the model artifact (see `artifact.py`)
+    def term_specs(self):
+        specs = []
+        for term in self.terms:
+            if term["type"] == "intercept":
+                specs.append({"type": "intercept"})
+                continue
+            specs.append({"type": "tensor", "marginals": [
+                {"feature": int(f), "n_splines": int(n), "spline_order": int(self.spline_order), "basis": "ps",
+                 "edge_knots": [float(k) for k in self.edge_knots_[f]]}
+                for f, n in zip(term["features"], self._term_n_splines(term))]})
+        return specs
+
+    def _term_n_splines(self, term):
+        n_splines = np.broadcast_to(self.n_splines, (len(term["features"]),))
+        return [int(n) for n in n_splines]
+
+    # non-zero values and columns of each row of a tensor term, i.e. the row-wise kronecker
+    # product of the non-zero windows of the marginal bases
+    def _tensor_basis(self, X, features):
+        values, columns, n_coefs = np.ones((len(X), 1)), np.zeros((len(X), 1), dtype=np.int64), 1
+        for f, n_splines in zip(features, self._term_n_splines({"features": features})):
+            basis = b_spline_basis(X[:, f], self.edge_knots_[f], n_splines, self.spline_order)
+            window = min(self.spline_order + 1, n_splines)
+            start = np.minimum(np.argmax(basis != 0, axis=1), n_splines - window)
+            cols = start[:, None] + np.arange(window)
+            vals = np.take_along_axis(basis, cols, axis=1)
+            values = (values[:, :, None] * vals[:, None, :]).reshape(len(X), -1)
+            columns = (columns[:, :, None] * n_splines + cols[:, None, :]).reshape(len(X), -1)
+            n_coefs *= n_splines
+        return values, columns, n_coefs
+
+    def _solve(self, A, b):
+        if self.solver == "cholesky":
+            if sparse_cholesky is not None:
+                return sparse_cholesky(A)(b)
+            return cho_solve(cho_factor(A.toarray()), b)
+        if self.solver == "cg":
+            diagonal = A.diagonal()
+            preconditioner = LinearOperator(A.shape, matvec=lambda v: v / diagonal)
+            x0 = self.coef_ if self.coef_ is not None and len(self.coef_) == len(b) else None
+            coef, info = cg(A, b, x0=x0, tol=self.tol, maxiter=self.max_iter, M=preconditioner)
+            if info > 0:
+                print("CG did not converge in %s iterations" % info)
+            return coef
+        raise ValueError("Unknown solver `%s`" % self.solver)
+
+# second order difference penalty D'D of n coefficients, same as pygam.penalties.derivative
+def _derivative_penalty(n):
+    if n == 1:
+        return sp.csc_matrix((1, 1))
+    D = sp.diags([1., -2., 1.], [0, 1, 2], shape=(n - 2, n))
+    return (D.T @ D).tocsc()
+
+def _to_array(X):
+    return X.to_numpy(dtype=np.float64) if hasattr(X, "to_numpy") else np.asarray(X, dtype=np.float64)
+
+# fit both backends on the training frame of a station and compare the predictions on the test frame
+def validate_backend(dataset, gam_params={"lam": 0.1}, te_params={"n_splines": 10}, num_fixed_col=12, solver="cholesky"):
+    from gam import initialise_gam
+    train_df, test_df = dataset["train"], dataset["test"]
+    train_df, train_label = train_df[test_df.columns], train_df["target"]
+    report = {}
+    predictions = {}
+    for backend in ["pygam", "sparse"]:
+        gam = initialise_gam(train_df, gam_params=gam_params, te_params=te_params, num_fixed_col=num_fixed_col-1, backend=backend)
+        if backend == "sparse":
+            gam.set_params(solver=solver)
+        fit_s = time.perf_counter()
+        gam.fit(train_df, train_label)
+        report["%s_fit_s" % backend] = time.perf_counter() - fit_s
+        predictions[backend] = gam.predict(test_df)
+    difference = np.abs(predictions["sparse"] - predictions["pygam"])
+    report["max_abs_diff"] = difference.max()
+    report["max_rel_diff"] = (difference / np.maximum(np.abs(predictions["pygam"]), 1e-12)).max()
+    return report
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Mar 17 09:05:00 2022
+@author: WOJJ
+
+Provide the streaming pre-processing of live load, national demand and weather feeds
+"""
+
+"""
+The batch pre-processing works on the whole series. For a live feed, StreamingPreprocessor
+takes the new samples one at a time and keeps the state of each step, so each sample costs
+O(1) (for a fixed window size and number of nearby stations):
+
+    - weather (hourly): exponential smoothing state per weather feed (last value and level),
+      the initial level is given or taken from a batch run over the history (`from_history`)
+    - load (15 minutes): running mean and variance (Welford) of each station for the outlier
+      bounds, then the centred moving average over a ring buffer (a box kernel, or two box
+      kernels for the triangular kernel), emitted (ws-1)//2 samples later
+    - national demand (30 minutes): centred weighted moving average, as for the load
+    - feature rows: the smoothed load of 56 days ago (own and nearby stations) is kept in
+      a time-keyed history, each row is emitted once the national demand and the weather
+      feeds have reached its time, rows with a missing feature are dropped
+
+The output matches the batch functions on the same data:
+    - smooth_weather, given the same initial level
+    - load_outlier_removal, given its bounds (`outlier_bounds`, e.g. from the batch run or a
+      model artifact), otherwise the bounds are updated with each sample (causal)
+    - avgeraged_smoothing / weighted_smoothing, including the zero padding at the start and,
+      after `flush`, at the end (the windows are positional, as in the batch)
+    - pack_frame: the rows of the train frame of pack_dataset (input_smoothed=False)
+
+    stream = StreamingPreprocessor(["BOURNVILLE CB 7"], outlier_bounds=bounds)
+    stream.update_weather(7, time, {"temperature": ..., ...})
+    stream.update_national_demand(time, value)
+    rows = stream.update_load("BOURNVILLE CB 7", time, value)
+    # [(station, time, features in the column order of stream.columns(station)), ...]
+"""
+
+import numpy as np
+import pandas as pd
+from collections import deque
+
+from data_loader import REGISTRY, required_stations
+from preprocess import ALPHAS, CALENDAR_COLUMNS, LAG_STEPS, smooth_weather
+
+# interval of the load samples
+STEP = pd.Timedelta(minutes=15)
+
+# exponential smoothing of one or more columns
+class ExponentialSmoother:
+    def __init__(self, alphas, initial_level=None):
+        self.alphas = np.asarray(alphas, dtype=float)
+        self.level = None if initial_level is None else np.asarray(initial_level, dtype=float)
+        self.last = None
+
+    # fitted value of the sample, the first sample is fitted by the initial level (itself if not given)
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        if self.last is None:
+            self.level = values.copy() if self.level is None else self.level
+        else:
+            self.level = self.alphas * self.last + (1 - self.alphas) * self.level
+        self.last = values
+        return self.level
+
+# running mean and population variance (Welford), NaN values are skipped
+class RunningStats:
+    def __init__(self):
+        self.n, self.mean, self.m2 = 0, 0., 0.
+
+    def update(self, x):
+        if np.isnan(x):
+            return
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.n) if self.n > 0 else np.nan
+
+    def bounds(self, n_times_std=3):
+        return (self.mean - n_times_std*self.std, self.mean + n_times_std*self.std)
+
+# running sums of (value, NaN count, valid count) over the last `length` samples
+class BoxSum:
+    def __init__(self, length):
+        self.buffer = deque([(0., 0., 0.)] * length, maxlen=length)
+        self.sums = [0., 0., 0.]
+
+    def update(self, sample):
+        oldest = self.buffer[0]
+        self.buffer.append(sample)
+        self.sums = [s + new - old for s, new, old in zip(self.sums, sample, oldest)]
+        return self.sums
+
+# centred moving average of `preprocess.smooth` (averaged or weighted kernel)
+class CentredSmoother:
+    def __init__(self, ws=7, method="averaged", skipna=False):
+        if method == "averaged":
+            lengths = [ws]
+        elif method == "weighted":
+            if ws % 2 == 0:
+                raise ValueError("weighted smoothing requires an odd window size, got %s" % ws)
+            lengths = [(ws + 1) // 2, (ws + 1) // 2]
+        else:
+            raise ValueError("Unknown smoothing method `%s`" % method)
+        self.boxes = [BoxSum(length) for length in lengths]
+        self.norm = float(np.prod(lengths))
+        self.offset = (ws - 1) // 2
+        self.skipna = skipna
+        self.times = deque()
+
+    # smoothed values (time, value) that can be emitted after this sample
+    def update(self, time, value):
+        self.times.append(time)
+        sample = (0., 1., 0.) if np.isnan(value) else (value, 0., 1.)
+        return self._emit(sample)
+
+    # smoothed values of the last samples, with the zero padding of the end of the series
+    def flush(self):
+        output = []
+        while len(self.times) > 0:
+            output += self._emit((0., 0., 0.), flush=True)
+        return output
+
+    def _emit(self, sample, flush=False):
+        for box in self.boxes:
+            sample = box.update(sample)
+        if len(self.times) <= self.offset and not flush:
+            return []
+        value, nan_count, valid_count = sample
+        if self.skipna:
+            result = value / valid_count if valid_count > 0 else np.nan
+        else:
+            result = value / self.norm if nan_count == 0 else np.nan
+        return [(self.times.popleft(), result)]
+
+# values of the recent times, older values are dropped beyond `horizon` from the latest one
+class TimedHistory:
+    def __init__(self, horizon):
+        self.horizon = horizon
+        self.values = {}
+        self.times = deque()
+        self.latest = None
+
+    def add(self, time, value):
+        self.values[time] = value
+        self.times.append(time)
+        self.latest = time
+        while self.times[0] < time - self.horizon:
+            del self.values[self.times.popleft()]
+
+    def get(self, time, default=np.nan):
+        return self.values.get(time, default)
+
+class StreamingPreprocessor:
+    def __init__(self, stations, registry=None, alphas=ALPHAS, load_ws=7, national_ws=5, skipna=False,
+                 n_times_std=3, outlier_bounds=None, weather_state=None, lag_steps=LAG_STEPS, max_delay=pd.Timedelta(days=7)):
+        registry = REGISTRY if registry is None else registry
+        self.stations = stations
+        self.nearby = {station: registry[station]["nearby"] for station in stations}
+        self.weather_of = {station: registry[station]["weather"] for station in stations}
+        self.alphas = alphas
+        self.lag = lag_steps * STEP
+        self.max_delay = max_delay
+        # load of the stations and their nearby stations
+        loads = required_stations(stations, registry)
+        self.outlier_removal = {station: registry[station]["outlier_removal"] for station in loads}
+        self.n_times_std = {station: registry[station].get("n_times_std", n_times_std) for station in loads}
+        self.outlier_bounds = outlier_bounds
+        self.load_stats = {station: RunningStats() for station in loads}
+        self.load_smoothers = {station: CentredSmoother(load_ws, "averaged", skipna) for station in loads}
+        self.load_history = {station: TimedHistory(self.lag + max_delay) for station in loads}
+        # national demand and weather feeds
+        self.national_smoother = CentredSmoother(national_ws, "weighted", skipna)
+        self.national = TimedHistory(max_delay)
+        weather_state = {} if weather_state is None else weather_state
+        self.weather_smoothers = {weather_id: weather_state.get(weather_id, ExponentialSmoother([alphas[col] for col in alphas]))
+                                  for weather_id in set(self.weather_of.values())}
+        self.weather = {weather_id: TimedHistory(max_delay) for weather_id in self.weather_smoothers}
+        # rows of each station waiting for the national demand and the weather
+        self.pending = {station: deque() for station in stations}
+
+    # state of the weather smoothing continuing a batch run over the history of the weather
+    @staticmethod
+    def from_history(weather, alphas=ALPHAS):
+        fitted = smooth_weather(weather, alphas.keys(), alphas=alphas)
+        smoother = ExponentialSmoother([alphas[col] for col in alphas])
+        smoother.level = np.array([fitted[col].iloc[-1] for col in alphas])
+        smoother.last = np.array([_transform_weather(col, weather[col].iloc[-1]) for col in alphas])
+        return smoother
+
+    # column order of the feature rows of a station, same as pack_frame
+    def columns(self, station):
+        return ['prev_2_mo', 'target', 'national'] + CALENDAR_COLUMNS + list(ALPHAS.keys()) + list(self.nearby[station])
+
+    def update_weather(self, weather_id, time, values):
+        if weather_id not in self.weather_smoothers:
+            return []
+        fitted = self.weather_smoothers[weather_id].update([_transform_weather(col, values[col]) for col in self.alphas])
+        self.weather[weather_id].add(time, dict(zip(self.alphas, fitted)))
+        return self._resolve([station for station in self.stations if self.weather_of[station] == weather_id])
+
+    def update_national_demand(self, time, value):
+        for smoothed_time, smoothed in self.national_smoother.update(time, value):
+            self.national.add(smoothed_time, smoothed)
+        return self._resolve(self.stations)
+
+    def update_load(self, station, time, value):
+        if self.outlier_removal[station]:
+            stats = self.load_stats[station]
+            stats.update(value)
+            if self.outlier_bounds is not None and station in self.outlier_bounds:
+                low, high = self.outlier_bounds[station]
+            else:
+                low, high = stats.bounds(self.n_times_std[station])
+            if value > high or value < low:
+                value = np.nan
+        return self._add_smoothed_load(station, self.load_smoothers[station].update(time, value))
+
+    # emit the last smoothed values and the rows waiting for them (end of the series)
+    def flush(self):
+        rows = []
+        for station, smoother in self.load_smoothers.items():
+            rows += self._add_smoothed_load(station, smoother.flush())
+        for smoothed_time, smoothed in self.national_smoother.flush():
+            self.national.add(smoothed_time, smoothed)
+        return rows + self._resolve(self.stations, final=True)
+
+    def _add_smoothed_load(self, station, smoothed_values):
+        for time, value in smoothed_values:
+            self.load_history[station].add(time, value)
+            if station in self.pending:
+                prev = self.load_history[station].get(time - self.lag)
+                nearby = [self.load_history[nearby_station].get(time - self.lag) for nearby_station in self.nearby[station]]
+                self.pending[station].append((time, value, prev, nearby))
+        return self._resolve([station]) if station in self.pending and len(smoothed_values) > 0 else []
+
+    # rows whose time has been reached by the national demand and weather feeds
+    def _resolve(self, stations, final=False):
+        rows = []
+        for station in stations:
+            pending, weather = self.pending[station], self.weather[self.weather_of[station]]
+            while len(pending) > 0 and (final or (self.national.latest is not None and weather.latest is not None
+                                                  and pending[0][0] <= min(self.national.latest, weather.latest))):
+                time, target, prev, nearby = pending.popleft()
+                weather_values = weather.get(time, None)
+                if weather_values is None:
+                    continue
+                features = [prev, target, self.national.get(time)] + _calendar(time) + [weather_values[col] for col in ALPHAS] + nearby
+                # rows with missing features are dropped as in pack_frame
+                if not np.isnan(features).any():
+                    rows.append((station, time, features))
+        return rows
+
+# same features as preprocess.calendar_features for one time
+def _calendar(time):
+    weekday = time.weekday() / 7 * 2 * np.pi
+    return [time.month, time.hour, time.dayofyear, np.sin(weekday), np.cos(weekday)]
+
+# cubic transformation of temperature, as in smooth_weather
+def _transform_weather(col, value):
+    return value + value**2 + value**3 if col == "temperature" else value
+
+# rows of one station as a pandas.DataFrame in the format of pack_frame
+def rows_to_frame(rows, columns):
+    return pd.DataFrame([features for _, _, features in rows], index=pd.DatetimeIndex([time for _, time, _ in rows]), columns=columns)
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Mar 14 08:30:00 2022
+@author: WOJJ
+
+Provide the hyperparameter sweep of N_SPLINES and LAMBDA
+"""
+
+"""
+The last VALIDATION_DAYS of the training set of each station are held out, and the
+GAM is fitted on the rest for every (n_splines, lam) candidate.
+
+The spline basis only depends on n_splines, and the penalty matrix is linear in lam.
+So for each station and n_splines, the terms of the GAM are compiled on the fitting rows
+(edge knots, without fitting) and the normal equations of its basis (see
+`gam.normal_equations`) are built once and reused for every lam: only
+(X'X + lam*P_1) b = X'y is solved for each lam. Both backends of `gam.initialise_gam`
+can be swept.
+
+The output error matrix is a pandas.DataFrame object (MAPE on the held-out days):
+
+                n_splines-4_lam-0.1     ...     n_splines-10_lam-1.0
+station_1       MAPE                    ...     MAPE
+station_2       MAPE                    ...     MAPE
+overall         MAPE mean               ...     MAPE mean
+"""
+
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.metrics import mean_absolute_percentage_error
+
+from gam import initialise_gam, compile_gam, normal_equations, solve_normal_equations
+
+VALIDATION_DAYS = 56
+
+def sweep(dataset_by_station, lams=[0.01, 0.1, 1, 10], n_splines=[4, 10], n_iter=None,
+          num_fixed_col=12, n_jobs=1, seed=0, backend="pygam"):
+    # grid search over lams x n_splines, or random search of n_iter candidates if n_iter is given
+    # (lam log-uniform between min(lams) and max(lams), n_splines drawn from n_splines)
+    if n_iter is None:
+        candidates = {n: sorted(lams) for n in n_splines}
+    else:
+        rng = np.random.default_rng(seed)
+        drawn_n = rng.choice(n_splines, size=n_iter)
+        drawn_lam = np.exp(rng.uniform(np.log(min(lams)), np.log(max(lams)), size=n_iter))
+        candidates = {n: sorted(drawn_lam[drawn_n == n]) for n in n_splines if any(drawn_n == n)}
+    tasks = [(station, dataset, n, candidates[n], num_fixed_col, backend)
+             for station, dataset in dataset_by_station.items() for n in candidates]
+    if n_jobs == 1:
+        results = [sweep_station(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(sweep_station, *zip(*tasks)))
+
+    keys = ["n_splines-%s_lam-%.4g" % (n, lam) for n in candidates for lam in candidates[n]]
+    errors = pd.DataFrame(index=list(dataset_by_station), columns=keys, dtype=float)
+    for (station, _, n, lams_n, _, _), result in zip(tasks, results):
+        for lam, error in zip(lams_n, result):
+            errors.loc[station, "n_splines-%s_lam-%.4g" % (n, lam)] = error
+    errors.loc["overall"] = errors.mean(axis=0)
+    print("="*20, "\nError Matrix of Sweep\n")
+    print(errors, "\n", "="*20)
+    return errors
+
+# held-out MAPE of one station for every lam of lams with the given n_splines
+def sweep_station(station, dataset, n_splines, lams, num_fixed_col=12, backend="pygam"):
+    train_df, test_df = dataset["train"], dataset["test"]
+    train_df, train_label = train_df[test_df.columns], train_df["target"]
+    split = train_df.index > train_df.index[-1] - pd.Timedelta(days=VALIDATION_DAYS)
+    fit_df, fit_label = train_df[~split], train_label[~split]
+    val_df, val_label = train_df[split], train_label[split]
+
+    gam = initialise_gam(fit_df, gam_params={"lam": lams[0]}, te_params={"n_splines": n_splines}, num_fixed_col=num_fixed_col-1, backend=backend) # -1 due to the target column
+    compile_gam(gam, fit_df)
+    normal_eq = normal_equations(gam, fit_df, fit_label)
+    P = gam._P() / lams[0]
+    val_modelmat = gam._modelmat(val_df)
+
+    errors = []
+    for lam in lams:
+        coef = solve_normal_equations(gam, normal_eq, P=P*lam)
+        errors.append(mean_absolute_percentage_error(val_label, val_modelmat.dot(coef)))
+    print(station, ' n_splines: %s, best lam: %.4g' % (n_splines, lams[int(np.argmin(errors))]))
+    return errors
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Mar 20 15:00:00 2022
+@author: WOJJ
+
+Tests of the GAM training on a small synthetic dataset
+
+    python -m pytest -q test_gam.py
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from gam import train_gam, update_gam
+from postprocess import generate_prediction
+
+FEATURES = ['prev_2_mo', 'national', 'month', 'hour', 'day', 'doW_x', 'doW_y',
+            'temperature', 'solar_irradiance', 'windspeed_north', 'windspeed_east']
+TE_PARAMS = {"n_splines": 4}
+
+# features in [0, 1] (the first two rows hold the bounds, so the knots do not depend on the later rows)
+# and a smooth target with noise correlated within the day, at the 15-minute steps of the packed datasets
+def synthetic_dataset(n_train=1500, n_test=96*3, seed=0):
+    rng = np.random.default_rng(seed)
+    n = n_train + n_test
+    index = pd.date_range("2021-01-01", periods=n, freq="15T")
+    df = pd.DataFrame(rng.uniform(size=(n, len(FEATURES))), index=index, columns=FEATURES)
+    df.iloc[0], df.iloc[1] = 0., 1.
+    noise = rng.normal(0, .1, n // 96 + 1)[np.arange(n) // 96] + rng.normal(0, .01, n)
+    train = df.iloc[:n_train].copy()
+    train.insert(1, "target", (mean_load(df) + noise).iloc[:n_train])
+    return {"train": train, "test": df.iloc[n_train:]}
+
+def mean_load(df):
+    return 2 + np.sin(3*df.prev_2_mo) * df.hour + df.month*df.national - df.windspeed_east**2
+
+# the statistics after an update are those of a fit on all the rows
+def test_update_covariance_matches_refit():
+    dataset = synthetic_dataset()
+    first = {"train": dataset["train"].iloc[:-300], "test": dataset["test"]}
+    trained_gam = train_gam({"s": first}, te_params=TE_PARAMS, incremental=True, uncertainty="covariance", n_samples=20)
+    updated = update_gam(trained_gam, {"s": dataset})["s"]["gam"].statistics_
+    refit = train_gam({"s": dataset}, te_params=TE_PARAMS)["s"]["gam"].statistics_
+    cov = updated["cov"]
+    assert np.linalg.eigvalsh(cov).min() > -1e-10 * np.abs(cov).max()
+    np.testing.assert_allclose(cov, refit["cov"], rtol=0, atol=1e-6 * np.abs(refit["cov"]).max())
+    np.testing.assert_allclose(updated["scale"], refit["scale"], rtol=1e-8)
+    np.testing.assert_allclose(updated["edof"], refit["edof"], rtol=1e-8)
+    assert updated["n_samples"] == refit["n_samples"] == len(dataset["train"])
+
+# the interval of the daily peak contains the post-processed point forecast
+@pytest.mark.parametrize("method", ["bootstrap", "covariance"])
+def test_interval_contains_point_forecast(method):
+    dataset = synthetic_dataset()
+    trained_gam = train_gam({"s": dataset}, te_params=TE_PARAMS, uncertainty=method, n_samples=200)
+    # load of the station plus a daily EV load
+    test_df = dataset["test"]
+    ev_load = .5 + .5*np.sin(np.arange(len(test_df))/96*2*np.pi)
+    combined_load = pd.DataFrame({"value": mean_load(test_df) + ev_load}, index=test_df.index)
+    generate_prediction(trained_gam, {"s": {"Combined Load": combined_load}}, method="daily_max")
+    result = trained_gam["s"]
+    assert result["prediction"].notna().all()
+    assert ((result["prediction_lower"] <= result["prediction"]) & (result["prediction"] <= result["prediction_upper"])).all()
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Mar 20 10:00:00 2022
+@author: WOJJ
+
+Regression tests of the exponential smoothing against statsmodels' SimpleExpSmoothing
+
+    python -m pytest -q test_preprocess.py
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from preprocess import exponential_smoothing
+
+holtwinters = pytest.importorskip("statsmodels.tsa.holtwinters")
+
+# small (temperature) and large (solar irradiance, wind speed) alpha of ALPHAS
+ALPHAS = [5e-2, 5e-1]
+
+# hourly series with a trend and a daily cycle, at the scale of a temperature
+def hourly_series(n=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    index = pd.date_range("2021-01-01", periods=n, freq="H")
+    return pd.Series(10 + np.cumsum(rng.normal(0, .3, n)) + 3*np.sin(np.arange(n)/24*2*np.pi), index=index)
+
+def transformed(v, cubic):
+    return v + v**2 + v**3 if cubic else v
+
+# same recursion as statsmodels for a given initial level (optimized=False)
+@pytest.mark.parametrize("alpha", ALPHAS)
+@pytest.mark.parametrize("cubic", [False, True])
+def test_recursion_matches_statsmodels(alpha, cubic):
+    v = hourly_series()
+    fit = holtwinters.SimpleExpSmoothing(transformed(v, cubic)).fit(smoothing_level=alpha, optimized=False)
+    result = exponential_smoothing(v, alpha, cubic=cubic, initial_level=fit.params["initial_level"])
+    np.testing.assert_allclose(result.to_numpy(), fit.fittedvalues.to_numpy(), rtol=1e-12)
+    assert result.index.equals(v.index)
+
+# the closed form initial level matches the one estimated by statsmodels (the previous implementation)
+@pytest.mark.parametrize("alpha", ALPHAS)
+@pytest.mark.parametrize("cubic", [False, True])
+def test_estimated_initial_level_matches_statsmodels(alpha, cubic):
+    v = hourly_series()
+    fit = holtwinters.SimpleExpSmoothing(transformed(v, cubic)).fit(smoothing_level=alpha)
+    result = exponential_smoothing(v, alpha, cubic=cubic)
+    # statsmodels' optimizer stops at its own tolerance
+    np.testing.assert_allclose(result.to_numpy(), fit.fittedvalues.to_numpy(), rtol=1e-4)
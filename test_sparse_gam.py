@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Mar 20 16:30:00 2022
+@author: WOJJ
+
+Equivalence of the sparse backend of the GAM and pygam on a small synthetic dataset
+
+    python -m pytest -q test_sparse_gam.py
+"""
+
+import numpy as np
+import pytest
+
+from gam import initialise_gam
+from test_gam import synthetic_dataset, TE_PARAMS
+
+def fitted(backend, dataset, **params):
+    train_df, test_df = dataset["train"], dataset["test"]
+    train_df, train_label = train_df[test_df.columns], train_df["target"]
+    gam = initialise_gam(train_df, te_params=TE_PARAMS, num_fixed_col=len(test_df.columns), backend=backend)
+    gam.set_params(**params)
+    return gam.fit(train_df, train_label)
+
+@pytest.fixture(scope="module")
+def dataset():
+    return synthetic_dataset()
+
+@pytest.fixture(scope="module")
+def pygam_gam(dataset):
+    return fitted("pygam", dataset)
+
+# same basis and penalty as pygam
+def test_basis_and_penalty_match_pygam(dataset, pygam_gam):
+    gam = fitted("sparse", dataset)
+    assert abs(gam._modelmat(dataset["test"]) - pygam_gam._modelmat(dataset["test"])).max() == 0
+    assert abs(gam._P() - pygam_gam._P()).max() == 0
+
+# the coefficients only differ in the directions held by the sqrt(EPS) ridge (no data, no penalty)
+def test_cholesky_matches_pygam(dataset, pygam_gam):
+    gam = fitted("sparse", dataset, solver="cholesky")
+    np.testing.assert_allclose(gam.coef_, pygam_gam.coef_, rtol=0, atol=1e-5 * np.abs(pygam_gam.coef_).max())
+    np.testing.assert_allclose(gam.predict(dataset["test"]), pygam_gam.predict(dataset["test"]), rtol=1e-10)
+
+# the conjugate gradient stops at its tolerance
+def test_cg_matches_pygam(dataset, pygam_gam):
+    gam = fitted("sparse", dataset, solver="cg")
+    np.testing.assert_allclose(gam.predict(dataset["test"]), pygam_gam.predict(dataset["test"]), rtol=1e-6)